@@ -0,0 +1,160 @@
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from tracing import call_traced, tracer
+
+# tells a stage worker there is nothing left to take from its inbox
+DONE = object()
+
+
+class BatchJob:
+    def __init__(self, index: int, arguments: dict):
+        self.index = index
+        self.arguments = arguments
+        self.job = None
+        self.source = None
+        self.layers = None
+        self.narration = None
+        self.timings = {}
+        self.error = None
+        self.started = time.time()
+
+
+def start_stage(name, func, inbox, outbox, workers, consumers):
+    '''Starts workers that apply func to each job from inbox and pass it on to outbox.
+    Failed jobs skip func and flow through, so they still reach the results file'''
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            item = inbox.get()
+            if item is DONE:
+                break
+            if item.error is None:
+                start = time.time()
+                try:
+                    with tracer.job_context(item.index), tracer.span(name):
+                        func(item)
+                except Exception:
+                    item.error = f'{name}: {traceback.format_exc()}'
+                item.timings[name] = round(time.time() - start, 3)
+            outbox.put(item)
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(consumers):
+                outbox.put(DONE)
+
+    threads = [threading.Thread(target=work, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def init_narration_worker():
+    # imported here so only the narration processes pay for the ML stack
+    from tts import preload_models
+    preload_models()
+
+
+def run_batch(generator, manifest: list, results_path: str, download_workers: int = 2, crop_workers: int = 2, narration_workers: int = 1, encode_workers: int = 1, queue_size: int = 2, trace_dir: str = None):
+    '''Runs download, crop, narration and encode as separate pools joined by bounded queues, so the network,
+    CPU and encoder work on different jobs at once. Writes one JSON line per finished job to results_path.
+    With trace_dir, each job's Chrome trace goes to {trace_dir}/{index}.json and the whole batch to batch.json'''
+    if trace_dir:
+        os.makedirs(trace_dir, exist_ok=True)
+        tracer.enable()
+    downloads = queue.Queue()
+    crops = queue.Queue(maxsize=queue_size)
+    encodes = queue.Queue(maxsize=queue_size)
+    finished = queue.Queue()
+    sources = set()
+    # sources of failed jobs are kept to retry them
+    kept = set()
+
+    # narration processes keep their models loaded for the whole batch
+    narrators = ProcessPoolExecutor(
+        narration_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_narration_worker,
+    )
+
+    def download(item):
+        item.job = generator._plan_job(**item.arguments)
+        task = generator._narration(item.job)
+        if task and tracer.enabled:
+            item.narration = narrators.submit(call_traced, 'narration', item.index, task)
+        elif task:
+            item.narration = narrators.submit(task)
+        item.source = generator._prepare_source(item.job)
+        if generator._disposable(item.job, item.source):
+            sources.add(item.source)
+
+    def crop(item):
+        if item.job['cache_dir']:
+            item.layers = generator._crop_layers(item.job, item.source)
+
+    def encode(item):
+        narration = None
+        if item.narration:
+            wait_start = time.time()
+            narration = item.narration.result()
+            if tracer.enabled:
+                narration, events = narration
+                tracer.merge(events)
+            item.timings['narration_wait'] = round(time.time() - wait_start, 3)
+        generator._render(item.job, item.source, item.layers, narration)
+
+    start_stage('download', download, downloads, crops, download_workers, crop_workers)
+    start_stage('crop', crop, crops, encodes, crop_workers, encode_workers)
+    start_stage('encode', encode, encodes, finished, encode_workers, 1)
+
+    for index, arguments in enumerate(manifest):
+        downloads.put(BatchJob(index, arguments))
+    for _ in range(download_workers):
+        downloads.put(DONE)
+
+    completed = 0
+    failures = 0
+    with open(results_path, 'w', encoding='utf-8') as results:
+        while True:
+            item = finished.get()
+            if item is DONE:
+                break
+            completed += 1
+            failures += item.error is not None
+            if item.error and item.source:
+                kept.add(item.source)
+            trace = trace_dir and os.path.join(trace_dir, f'{item.index}.json')
+            if trace:
+                tracer.write(trace, job=item.index)
+            results.write(json.dumps({
+                'index': item.index,
+                'path': item.arguments.get('path'),
+                'output': item.job and f"{item.job['output']}.mp4",
+                'outputs': item.job and generator._outputs(item.job),
+                'status': 'failed' if item.error else 'ok',
+                'error': item.error,
+                'timings': item.timings,
+                'total': round(time.time() - item.started, 3),
+                'trace': trace,
+            }) + '\n')
+            results.flush()
+            print(f"Job {item.index} {'failed' if item.error else 'done'} ({completed}/{len(manifest)})")
+
+    narrators.shutdown()
+    if trace_dir:
+        tracer.write(os.path.join(trace_dir, 'batch.json'))
+    # sources are shared by jobs that render the same clip, so they go once every job is done
+    for source in sources - kept:
+        if os.path.exists(source):
+            os.remove(source)
+    print(f"Batch finished: {len(manifest) - failures} ok, {failures} failed, results in {results_path}")
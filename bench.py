@@ -0,0 +1,303 @@
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import fire
+
+from layout import Layout
+from render import background_blur_filter, background_crop, blur_video, box_crop, create_mobile_video, crop_video, render_filtergraph, render_mobile_video
+from subtitles import write_ass_subtitles
+
+
+# the modules each lightweight command imports before it starts working, and its startup budget
+STARTUP_BUDGETS_MS = {
+    'blur': (('gen',), 250),
+    'crop_box': (('gen',), 250),
+    'blur_box': (('gen',), 250),
+    'detect': (('gen', 'facial_detection'), 600),
+}
+# only narration may import these
+NARRATION_MODULES = ('torch', 'whisper', 'TTS', 'pydub', 'gtts')
+
+# the suite always encodes with libx264 so its numbers don't depend on which encoders a machine has
+BENCH_CODEC = '-c:v libx264 -preset veryfast -crf 20 -c:a aac -b:a 192k -pix_fmt yuv420p'
+# source size and the vertical output rendered from it
+SUITE_RESOLUTIONS = {
+    '1080p': ((1920, 1080), (1080, 1920)),
+    '4k': ((3840, 2160), (2160, 3840)),
+}
+# a stage that takes this much longer than its baseline is a regression
+REGRESSION_TOLERANCE = 0.15
+
+
+def make_face(path: str, size: int = 256):
+    '''Draws a plain frontal face, enough for the Haar cascade to find something to track'''
+    import cv2
+    import numpy
+    image = numpy.full((size, size, 3), 60, numpy.uint8)
+    center = size // 2
+    cv2.ellipse(image, (center, center), (int(size * 0.36), int(size * 0.46)), 0, 0, 360, (150, 180, 215), -1)
+    for side in (-1, 1):
+        eye = (center + side * int(size * 0.15), int(size * 0.4))
+        cv2.ellipse(image, (eye[0], eye[1] - int(size * 0.08)), (int(size * 0.1), int(size * 0.025)), 0, 180, 360, (40, 50, 60), -1)
+        cv2.ellipse(image, eye, (int(size * 0.08), int(size * 0.04)), 0, 0, 360, (240, 240, 240), -1)
+        cv2.circle(image, eye, int(size * 0.03), (30, 30, 30), -1)
+    cv2.line(image, (center, int(size * 0.45)), (center - int(size * 0.04), int(size * 0.6)), (110, 130, 170), 3)
+    cv2.ellipse(image, (center, int(size * 0.72)), (int(size * 0.14), int(size * 0.05)), 0, 0, 180, (60, 60, 140), -1)
+    cv2.imwrite(path, image)
+    return path
+
+
+def make_clip(path: str, width: int = 1920, height: int = 1080, duration: float = 5, fps: int = 60, face: str = None):
+    '''Builds a deterministic test clip with ffmpeg's lavfi sources, optionally with face drifting around a facecam corner'''
+    inputs = f'-f lavfi -i testsrc2=s={width}x{height}:r={fps}:d={duration} -f lavfi -i sine=frequency=440:duration={duration}'
+    maps = '-shortest'
+    if face:
+        size = height // 4
+        inputs += f' -loop 1 -i {face}'
+        maps = (
+            f'-filter_complex "[2:v] scale={size}:{size} [face]; '
+            f"[0:v][face] overlay=x='W/20+W/60*sin(t)':y='H/20+H/80*cos(t)':shortest=1 [v]\" "
+            f'-map "[v]" -map 1:a -t {duration}'
+        )
+    cmd = f'ffmpeg -y -v error {inputs} {maps} -c:v libx264 -preset ultrafast -c:a aac {path}'
+    subprocess.run(cmd, shell=True, check=True)
+    return path
+
+
+def synthetic_captions(count: int, duration: float):
+    '''Spreads count six-word captions (two drawtext chunks each) evenly over duration'''
+    step = duration / max(count, 1)
+    return [(i * step, (i + 1) * step, f'caption {i} has six words here') for i in range(count)]
+
+
+def time_filtergraph(input_args: str, filter_complex: str, audio_map: str) -> float:
+    '''Runs the composition into the null muxer, so only decode and filtering are measured'''
+    cmd = f'ffmpeg -y -v error {input_args} -filter_complex "{filter_complex}" {audio_map} -f null -'
+    start = time.time()
+    subprocess.run(cmd, shell=True, check=True)
+    return time.time() - start
+
+
+def blur_psnr(source: str, reference_filter: str, test_filter: str) -> float:
+    '''Returns the average PSNR of test_filter's output against reference_filter's, both applied to source'''
+    filter_complex = f'[0:v] split=2 [r][t]; [r] {reference_filter} [ref]; [t] {test_filter} [test]; [test][ref] psnr'
+    cmd = f'ffmpeg -y -i {source} -filter_complex "{filter_complex}" -f null -'
+    output = subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True).stderr
+    return float(re.findall(r'average:(\S+)', output)[-1])
+
+
+def import_times(modules) -> dict:
+    '''Imports modules in a fresh interpreter with -X importtime and returns every imported module's cumulative ms'''
+    cmd = [sys.executable, '-X', 'importtime', '-c', f"import {', '.join(modules)}"]
+    output = subprocess.run(cmd, capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stderr
+    times = {}
+    for line in output.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (.+)$', line)
+        if match:
+            # nested imports are indented, keep the name and the outermost timing
+            times.setdefault(match.group(2).strip(), int(match.group(1)) / 1000)
+    return times
+
+
+def write_srt(path: str, count: int, step: float = 2.0):
+    '''Writes count Whisper-style SRT entries'''
+    def timestamp(seconds):
+        return f'{int(seconds // 3600):02}:{int(seconds % 3600 // 60):02}:{int(seconds % 60):02},{int(seconds * 1000 % 1000):03}'
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(count):
+            f.write(f'{i + 1}\n{timestamp(i * step)} --> {timestamp((i + 1) * step)}\ncaption {i} has six words here\n\n')
+    return path
+
+
+def time_stage(func, output: str = None, repeat: int = 3) -> float:
+    '''Returns the best of repeat runs of func, or raises when it didn't write output (ffmpeg failures are silent)'''
+    best = None
+    for _ in range(repeat):
+        if output and os.path.exists(output):
+            os.remove(output)
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if output and not os.path.exists(output):
+            raise RuntimeError(f'{output} was not written')
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def environment() -> dict:
+    ffmpeg = subprocess.run('ffmpeg -version', shell=True, capture_output=True, text=True).stdout.split('\n')[0]
+    return {'ffmpeg': ffmpeg, 'cpus': os.cpu_count(), 'platform': platform.platform(), 'python': platform.python_version()}
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE) -> list:
+    '''Prints each stage against its baseline time and returns the stages that got slower than tolerance allows,
+    or that failed where the baseline has a time for them'''
+    if baseline.get('environment') != results['environment'] or baseline.get('settings') != results['settings']:
+        print('Baseline was recorded on a different machine, toolchain or settings, differences may not be regressions')
+    regressions = []
+    for stage, seconds in results['stages'].items():
+        before = baseline.get('stages', {}).get(stage)
+        if before is None:
+            continue
+        if seconds is None:
+            print(f"{stage:<40} {before:8.3f}s -> failed  REGRESSION")
+            regressions.append(stage)
+            continue
+        change = seconds / before - 1
+        regressed = change > tolerance
+        print(f"{stage:<40} {before:8.3f}s -> {seconds:8.3f}s {change:+7.1%}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(stage)
+    return regressions
+
+
+class Benchmarks:
+    def captions(self, counts=(0, 10, 100), duration: float = 5, fps: int = 60, width: int = 2160, height: int = 3840):
+        '''Compares render fps of the drawtext chain against a single ASS layer as the caption count grows'''
+        if isinstance(counts, (int, str)):
+            counts = [int(c) for c in str(counts).split(',')]
+        results = []
+        with tempfile.TemporaryDirectory() as workdir:
+            source = make_clip(os.path.join(workdir, 'source.mp4'), duration=duration, fps=fps)
+            subtitle_file = os.path.join(workdir, 'captions.ass')
+            frames = duration * fps
+            for count in counts:
+                captions = synthetic_captions(count, duration)
+                kwargs = dict(
+                    width=width, height=height, captions=captions,
+                    overlay_text_top='BENCHMARK TITLE THAT WRAPS OVER TWO LINES', overlay_text_bottom='Benchmark subtitle',
+                )
+                drawtext = time_filtergraph(*render_filtergraph(source, 1920, 1080, **kwargs))
+                write_ass_subtitles(subtitle_file, width, height, kwargs['overlay_text_top'], kwargs['overlay_text_bottom'], captions)
+                ass = time_filtergraph(*render_filtergraph(source, 1920, 1080, subtitle_file=subtitle_file, **kwargs))
+                results.append({
+                    'captions': count,
+                    'drawtext_fps': round(frames / drawtext, 2),
+                    'ass_fps': round(frames / ass, 2),
+                })
+                print(f"{count:>5} captions: drawtext {results[-1]['drawtext_fps']} fps, ass {results[-1]['ass_fps']} fps")
+        return results
+
+    def blur(self, qualities=(1.0, 0.5, 0.25, 0.125), duration: float = 5, fps: int = 60, width: int = 2160, height: int = 3840, strength: int = 20):
+        '''Compares the per-frame cost of the background crop and blur at several working sizes against blurring the full frame'''
+        if isinstance(qualities, (int, float, str)):
+            qualities = [float(q) for q in str(qualities).split(',')]
+        radius = Layout(width, height).blur(strength)
+        crop = background_crop(1920, 1080)
+        frames = duration * fps
+        results = []
+        with tempfile.TemporaryDirectory() as workdir:
+            source = make_clip(os.path.join(workdir, 'source.mp4'), duration=duration, fps=fps)
+            # decoding is the same for every quality, time it once and leave it out
+            decode = time_filtergraph(f'-i {source}', '[0:v] null [bg]', '-map "[bg]"')
+            reference = background_blur_filter(width, height, radius, 1.0, crop)
+            for quality in qualities:
+                blur_filter = background_blur_filter(width, height, radius, quality, crop)
+                elapsed = time_filtergraph(f'-i {source}', f'[0:v] {blur_filter} [bg]', '-map "[bg]"')
+                results.append({
+                    'quality': quality,
+                    'ms_per_frame': round(max(elapsed - decode, 0) / frames * 1000, 2),
+                    'psnr': blur_psnr(source, reference, blur_filter) if quality < 1 else float('inf'),
+                })
+            full = next((r['ms_per_frame'] for r in results if r['quality'] >= 1), None)
+            for result in results:
+                if full:
+                    result['saved_ms_per_frame'] = round(full - result['ms_per_frame'], 2)
+                print(f"quality {result['quality']:>5}: {result['ms_per_frame']} ms/frame, psnr {result['psnr']} dB vs full blur")
+        return results
+
+    def suite(self, resolutions='1080p,4k', duration: float = 5, fps: int = 30, repeat: int = 3,
+              output: str = 'bench_results.json', baseline: str = 'bench_baseline.json', update_baseline: bool = False,
+              tolerance: float = REGRESSION_TOLERANCE):
+        '''Times every stage in isolation on synthetic clips, writes the results to output and compares them with
+        baseline. Exits non-zero on a regression, update_baseline stores this run as the new baseline instead'''
+        if isinstance(resolutions, str):
+            resolutions = resolutions.split(',')
+        # imported here so the other benchmarks don't pay for OpenCV
+        from facial_detection import facecam_box, find_faces, to_detections
+        from tts import merge_voiceover_with_video_audio, parse_srt_to_tuples
+
+        stages = {}
+        errors = {}
+
+        def run(stage, func, output=None):
+            try:
+                stages[stage] = round(time_stage(func, output, repeat), 4)
+            except Exception as e:
+                stages[stage] = None
+                errors[stage] = str(e)
+            print(f"{stage:<40} {stages[stage]}s" if stages[stage] is not None else f"{stage:<40} failed: {errors[stage]}")
+
+        with tempfile.TemporaryDirectory() as workdir:
+            def path(name):
+                return os.path.join(workdir, name)
+
+            face = make_face(path('face.png'))
+            voice = make_clip(path('voice.mp4'), 320, 240, duration, fps)
+            subprocess.run(f'ffmpeg -y -v error -i {voice} -vn {path("voice.mp3")}', shell=True, check=True)
+            srt = write_srt(path('captions.srt'), 1000)
+            run('srt_parse[1000 entries]', lambda: parse_srt_to_tuples(srt, 8.0))
+
+            for name in resolutions:
+                (source_width, source_height), (width, height) = SUITE_RESOLUTIONS[name]
+                source = make_clip(path(f'{name}.mp4'), source_width, source_height, duration, fps, face)
+                background, content = path(f'{name}_background.mp4'), path(f'{name}_content.mp4')
+                crop = background_crop(source_width, source_height)
+                run(f'{name}/crop_video', lambda: crop_video(source, background, *crop, width, height, codec_args=BENCH_CODEC), background)
+                crop_video(source, content, *box_crop(source_width, source_height), width, width, codec_args=BENCH_CODEC)
+                run(f'{name}/blur_video', lambda: blur_video(source, path('blurred.mp4'), codec_args=BENCH_CODEC), path('blurred.mp4'))
+                for count in (0, 10, 100):
+                    captions = synthetic_captions(count, duration)
+                    run(f'{name}/create_mobile_video[{count} captions]', lambda: create_mobile_video(
+                        background, content, path('mobile.mp4'), 'BENCHMARK TITLE', 'Benchmark subtitle', captions,
+                        fps=fps, codec_args=BENCH_CODEC,
+                    ), path('mobile.mp4'))
+                    run(f'{name}/render_mobile_video[{count} captions]', lambda: render_mobile_video(
+                        source, path('rendered.mp4'), width=width, height=height, overlay_text_top='BENCHMARK TITLE',
+                        overlay_text_bottom='Benchmark subtitle', captions=captions, fps=fps, codec_args=BENCH_CODEC,
+                    ), path('rendered.mp4'))
+                run(f'{name}/facial_detection', lambda: facecam_box(to_detections(find_faces(source, 1), 1)))
+                run(f'{name}/audio_merge', lambda: merge_voiceover_with_video_audio(source, path('voice.mp3'), path('merged.mp4'), 1.0), path('merged.mp4'))
+
+        results = {'environment': environment(), 'settings': {'duration': duration, 'fps': fps, 'repeat': repeat}, 'stages': stages, 'errors': errors}
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {output}")
+
+        if update_baseline or not os.path.exists(baseline):
+            with open(baseline, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"Baseline written to {baseline}")
+            return
+        with open(baseline) as f:
+            regressions = compare_results(results, json.load(f), tolerance)
+        if regressions:
+            raise SystemExit(f"Slower than {baseline} or failed: {', '.join(regressions)}")
+
+    def startup(self, runs: int = 3):
+        '''Checks the import time of the lightweight commands against STARTUP_BUDGETS_MS and that none of them
+        imports the narration stack. Exits non-zero when one is over, so it can gate CI'''
+        failures = []
+        results = []
+        for command, (modules, budget) in STARTUP_BUDGETS_MS.items():
+            # the best of a few runs, the first one also pays for a cold disk cache
+            samples = [import_times(modules) for _ in range(runs)]
+            elapsed = min(sum(times[module] for module in modules) for times in samples)
+            heavy = sorted({name for name in samples[0] if name.split('.')[0] in NARRATION_MODULES})
+            results.append({'command': command, 'import_ms': round(elapsed, 1), 'budget_ms': budget, 'heavy_imports': heavy})
+            print(f"{command:>9}: {elapsed:.1f} ms of {budget} ms" + (f", imports {', '.join(heavy)}" if heavy else ''))
+            if elapsed > budget or heavy:
+                failures.append(command)
+        if failures:
+            raise SystemExit(f"Startup budget exceeded by: {', '.join(failures)}")
+        return results
+
+
+if __name__ == '__main__':
+    fire.Fire(Benchmarks)
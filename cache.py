@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+CHUNK_SIZE = 1024 * 1024
+# marks files that are still being written into a cache directory
+TEMP_MARKER = '.tmp'
+STATS_FILE = 'stats.json'
+
+# per-entry locks shared by every MediaCache on the same directory
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def file_hash(path: str) -> str:
+    '''Returns the sha256 of a file's contents, read in chunks so large videos never sit in memory'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def temp_path(path: str) -> str:
+    '''Returns a unique name next to path to write it under before moving it into place, one per thread and process.
+    The real extension stays last so ffmpeg still picks the right muxer'''
+    base, ext = os.path.splitext(path)
+    return f'{base}.{uuid.uuid4().hex}{TEMP_MARKER}{ext}'
+
+
+def cache_key(*parts) -> str:
+    '''Returns a stable hash of the given parameters, e.g. a content hash plus the settings applied to it'''
+    encoded = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class MediaCache:
+    '''Content-addressed directory of rendered files, evicting the least recently used ones over a byte budget'''
+
+    def __init__(self, directory: str = '.cache', budget: int = 20 * 1024 ** 3, suffix: str = '.mp4', sidecars: tuple = ()):
+        self.directory = directory
+        self.budget = budget
+        self.suffix = suffix
+        # extra files stored next to an entry (e.g. '.json'), evicted along with it
+        self.sidecars = sidecars
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str, suffix: str = None) -> str:
+        return os.path.join(self.directory, key + (suffix or self.suffix))
+
+    def __contains__(self, key: str) -> bool:
+        return all(os.path.exists(p) for p in self.entry_files(self.path(key)))
+
+    def entry_files(self, path: str) -> list:
+        base = path[:-len(self.suffix)]
+        return [path] + [base + sidecar for sidecar in self.sidecars]
+
+    def get(self, key: str):
+        '''Returns the cached file for key, or None on a miss'''
+        path = self.path(key)
+        if key not in self:
+            self.record(hit=False)
+            return None
+        # the mtime doubles as the last use time for eviction
+        os.utime(path)
+        self.record(hit=True)
+        return path
+
+    def stats(self) -> dict:
+        '''Returns the hits and misses recorded for this cache directory across runs'''
+        try:
+            with open(os.path.join(self.directory, STATS_FILE)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {'hits': 0, 'misses': 0}
+
+    def record(self, hit: bool):
+        stats = self.stats()
+        stats['hits' if hit else 'misses'] += 1
+        stats_path = os.path.join(self.directory, STATS_FILE)
+        temp_stats = temp_path(stats_path)
+        with open(temp_stats, 'w') as f:
+            json.dump(stats, f)
+        os.replace(temp_stats, stats_path)
+
+    def put(self, key: str, produce) -> str:
+        '''Calls produce(path) to write the entry to a temporary file, then moves it into place'''
+        path = self.path(key)
+        temp_entry = temp_path(path)
+        try:
+            produce(temp_entry)
+            if not os.path.exists(temp_entry):
+                raise RuntimeError(f"Failed to produce cache entry {key}")
+            os.replace(temp_entry, path)
+        finally:
+            if os.path.exists(temp_entry):
+                os.remove(temp_entry)
+        self.evict(keep=path)
+        return path
+
+    def lock(self, key: str) -> threading.Lock:
+        '''Returns the lock for an entry, so concurrent misses on it produce it once'''
+        with _locks_lock:
+            return _locks.setdefault((os.path.abspath(self.directory), key), threading.Lock())
+
+    def fetch(self, key: str, produce) -> str:
+        '''Returns the cached file for key, producing it first on a miss. Threads missing the same key wait for the first'''
+        with self.lock(key):
+            path = self.get(key)
+            if path:
+                print(f"Cache hit: {path}")
+                return path
+            return self.put(key, produce)
+
+    def evict(self, keep: str = None):
+        '''Deletes the least recently used entries until the cache fits its budget'''
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if TEMP_MARKER in name or not name.endswith(self.suffix) or path == keep:
+                continue
+            size = sum(os.path.getsize(p) for p in self.entry_files(path) if os.path.exists(p))
+            entries.append((os.path.getmtime(path), size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if keep:
+            total += sum(os.path.getsize(p) for p in self.entry_files(keep) if os.path.exists(p))
+        for _, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            for entry_file in self.entry_files(path):
+                if os.path.exists(entry_file):
+                    os.remove(entry_file)
+            total -= size
+            print(f"Evicted {path} from cache")
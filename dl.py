@@ -1,21 +1,67 @@
 import os
 from yt_dlp import YoutubeDL
+from yt_dlp.utils import download_range_func
 
-def download(url, output_dir, output_format=None, cookies=None):
-    if output_format is None:
-        output_format = 'bestvideo[height<=2160]+bestaudio/best[height<=2160]/best'
+DEFAULT_FORMAT = 'bestvideo[height<=2160]+bestaudio/best[height<=2160]/best'
 
+
+def plan_format(formats, min_height: int) -> str:
+    '''Returns a format selector for the smallest video at least min_height tall, or the tallest when none is,
+    with the best audio when the video has none. Falls back to DEFAULT_FORMAT when no format has a height'''
+    videos = [f for f in formats if f.get('height') and f.get('vcodec') != 'none']
+    if not videos:
+        return DEFAULT_FORMAT
+    size = lambda f: (f['height'], f.get('filesize') or f.get('filesize_approx') or f.get('tbr') or 0)
+    adequate = [f for f in videos if f['height'] >= min_height]
+    chosen = min(adequate, key=size) if adequate else max(videos, key=size)
+    if chosen.get('acodec') == 'none':
+        return f"{chosen['format_id']}+bestaudio/{chosen['format_id']}"
+    return chosen['format_id']
+
+
+def use_planned_format(ydl, info_dict, min_height: int) -> str:
+    '''Switches ydl to the format plan_format picks from info_dict and returns it. YoutubeDL compiles its
+    selector from params['format'] once when it's built, so the selector itself is replaced'''
+    output_format = plan_format(info_dict.get('formats') or [info_dict], min_height)
+    ydl.params['format'] = output_format
+    ydl.format_selector = ydl.build_format_selector(output_format)
+    return output_format
+
+
+def media_url(url, output_format='bestaudio/best', cookies=None):
+    '''Resolves a page URL to the direct URL of one of its formats, for ffmpeg to stream without a download'''
+    ydl_opts = {'format': output_format, 'noplaylist': True, 'quiet': True}
+    if cookies:
+        ydl_opts['cookiefile'] = cookies
+    with YoutubeDL(ydl_opts) as ydl:
+        info_dict = ydl.extract_info(url, download=False)
+    return info_dict.get('url') or info_dict['requested_formats'][0]['url']
+
+
+def download(url, output_dir, output_format=None, cookies=None, min_height=None, start=None, end=None):
+    '''Downloads url into output_dir. With min_height the format is planned from the site's format list,
+    and start/end download only that part of the video'''
     ydl_opts = {
-        'format': output_format,
+        'format': output_format or DEFAULT_FORMAT,
         'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
         'noplaylist': True,
     }
-    
+
     if cookies:
         ydl_opts['cookiefile'] = cookies
+    if start is not None or end is not None:
+        ydl_opts['download_ranges'] = download_range_func(None, [(start or 0, end if end is not None else float('inf'))])
+        # ranges of one video get their own files
+        ydl_opts['outtmpl'] = os.path.join(output_dir, f'%(title)s_{start or 0:g}-{end if end is not None else "end"}.%(ext)s')
 
     with YoutubeDL(ydl_opts) as ydl:
-        info_dict = ydl.extract_info(url, download=True)
+        if min_height and output_format is None:
+            info_dict = ydl.extract_info(url, download=False)
+            output_format = use_planned_format(ydl, info_dict, min_height)
+            print(f"Fetching format {output_format} for a {min_height}p render")
+            info_dict = ydl.process_ie_result(info_dict, download=True)
+        else:
+            info_dict = ydl.extract_info(url, download=True)
         file_name = ydl.prepare_filename(info_dict)
 
     return file_name
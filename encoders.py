@@ -0,0 +1,94 @@
+import functools
+import re
+import subprocess
+
+AUDIO_ARGS = '-c:a aac -b:a 192k'
+PIXEL_FORMAT = '-pix_fmt yuv420p'
+
+# per target, the encoders to try in order of preference with their settings
+PROFILES = {
+    'quality': [
+        ('h264_nvenc', '-preset p7 -rc vbr -cq 19 -b:v 0'),
+        ('libx264', '-preset slow -crf 18'),
+        ('libx265', '-preset medium -crf 20 -tag:v hvc1'),
+    ],
+    'throughput': [
+        ('h264_nvenc', '-preset p1 -rc vbr -cq 21 -b:v 0'),
+        ('libx264', '-preset veryfast -crf 20'),
+        ('libsvtav1', '-preset 10 -crf 32'),
+    ],
+    'size': [
+        ('libsvtav1', '-preset 6 -crf 30'),
+        ('libx265', '-preset slow -crf 24 -tag:v hvc1'),
+        ('libx264', '-preset slower -crf 23'),
+    ],
+    'draft': [
+        ('libx264', '-preset ultrafast -crf 30'),
+        ('h264_nvenc', '-preset p1 -rc vbr -cq 30 -b:v 0'),
+    ],
+    # crop layers that get encoded again, near lossless and quick
+    'intermediate': [
+        ('libx264', '-preset veryfast -crf 16'),
+        ('h264_nvenc', '-preset p4 -rc vbr -cq 16 -b:v 0'),
+    ],
+}
+# settings for an encoder asked for by name that the target doesn't list
+DEFAULT_SETTINGS = {
+    'libx264': '-preset medium -crf 20',
+    'libx265': '-preset medium -crf 22 -tag:v hvc1',
+    'libsvtav1': '-preset 8 -crf 30',
+    'h264_nvenc': '-preset p5 -rc vbr -cq 20 -b:v 0',
+    'hevc_nvenc': '-preset p5 -rc vbr -cq 22 -b:v 0 -tag:v hvc1',
+}
+THREAD_ARGS = {
+    'libx264': '-threads {threads}',
+    'libx265': '-x265-params pools={threads}',
+    'libsvtav1': '-svtav1-params lp={threads}',
+}
+# listed by ffmpeg whenever it was built with them, even on machines without the hardware
+HARDWARE_SUFFIXES = ('_nvenc', '_qsv', '_vaapi', '_amf', '_videotoolbox')
+
+
+@functools.lru_cache(maxsize=None)
+def available_encoders() -> frozenset:
+    '''Returns the names of the video encoders this ffmpeg was built with'''
+    output = subprocess.run('ffmpeg -hide_banner -encoders', shell=True, capture_output=True).stdout.decode()
+    # the flag legend above the separator looks like encoder lines too
+    listing = output.split(' ------', 1)[-1]
+    return frozenset(re.findall(r'^\s*V\S*\s+(\S+)', listing, re.MULTILINE))
+
+
+@functools.lru_cache(maxsize=None)
+def encoder_works(encoder: str) -> bool:
+    '''Checks that the encoder is built in and, for hardware encoders, that it can actually open a device'''
+    if encoder not in available_encoders():
+        return False
+    if not encoder.endswith(HARDWARE_SUFFIXES):
+        return True
+    cmd = f'ffmpeg -v error -f lavfi -i color=s=256x256:d=0.1 -frames:v 1 -c:v {encoder} -f null -'
+    return subprocess.run(cmd, shell=True, capture_output=True).returncode == 0
+
+
+@functools.lru_cache(maxsize=None)
+def select_encoder(target: str = 'quality', encoder: str = None) -> tuple[str]:
+    '''Returns the (encoder, settings) to use for target, falling back down the profile to what this machine can run'''
+    if target not in PROFILES:
+        raise ValueError(f"Unknown encoder target {target}, expected one of {', '.join(PROFILES)}")
+    candidates = PROFILES[target]
+    if encoder:
+        settings = dict(candidates).get(encoder, DEFAULT_SETTINGS.get(encoder, ''))
+        candidates = [(encoder, settings)] + candidates
+    for name, settings in candidates:
+        if encoder_works(name):
+            return name, settings
+        print(f"Encoder {name} is not available, trying the next one")
+    raise RuntimeError(f"None of the {target} encoders work with this ffmpeg: {', '.join(name for name, _ in candidates)}")
+
+
+def encoder_args(target: str = 'quality', encoder: str = None, threads: int = None, audio_args: str = AUDIO_ARGS) -> str:
+    '''Returns the ffmpeg output codec arguments for target'''
+    name, settings = select_encoder(target, encoder)
+    args = f'-c:v {name} {settings}'
+    if threads and name in THREAD_ARGS:
+        args += ' ' + THREAD_ARGS[name].format(threads=threads)
+    return f'{args} {audio_args} {PIXEL_FORMAT}'
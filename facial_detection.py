@@ -1,32 +1,194 @@
-import asyncio
 import os
 import subprocess
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import cv2
 import numpy
 
 import math
 
+from cache import cache_key, file_hash, temp_path
+from render import extract_resolution, extract_duration
+from tracing import traced, tracer
+
 scale_factor = 1.2
 min_neighbors = 3
 min_size = (50, 50)
+# frames are downscaled to this width before detection
+detection_width = 960
+# one row per detected face
+detection_dtype = numpy.dtype([
+    ('frame', 'i4'), ('time', 'f8'),
+    ('x', 'i4'), ('y', 'i4'), ('w', 'i4'), ('h', 'i4'),
+])
+# frames sent to a worker process at a time
+batch_size = 16
+cascade_path = 'haarcascade/haarcascade_frontalface_alt2.xml'
+# minimum normalized correlation for the tracker to keep following a face
+track_threshold = 0.5
+
+# loaded once per process, see load_cascade
+_cascade = None
+
+
+def load_cascade():
+    '''Returns this process' classifier, loading the cascade XML on first use'''
+    global _cascade
+    if _cascade is None:
+        _cascade = cv2.CascadeClassifier(cascade_path)
+    return _cascade
+
+
+def init_worker():
+    # one worker per core, so keep OpenCV from spawning its own threads on top
+    cv2.setNumThreads(1)
+    load_cascade()
+
+
+def detect_faces(gray, face_size=min_size):
+    faces = load_cascade().detectMultiScale(
+        gray, scaleFactor=scale_factor, minNeighbors=min_neighbors, minSize=face_size)
+    return [tuple(int(v) for v in face) for face in faces]
+
+
+def detect_batch(frames, face_size=min_size):
+    '''Runs detection over a stacked batch of frames, returns the faces of each frame in order'''
+    return [detect_faces(frame, face_size) for frame in frames]
+
+
+def detection_resolution(video_path):
+    '''Returns the source resolution and the downscaled resolution frames are decoded at for detection'''
+    width, height = extract_resolution(video_path)
+    scan_width = min(detection_width, width)
+    scan_height = round(height * scan_width / width)
+    # rawvideo needs even dimensions for most scalers
+    scan_width -= scan_width % 2
+    scan_height -= scan_height % 2
+    return (width, height), (scan_width, scan_height)
+
+
+def read_frame(stream, view, frame_size):
+    '''Fills view with the next frame from stream, returns False at the end of the stream'''
+    read = 0
+    while read < frame_size:
+        count = stream.readinto(view[read:])
+        if not count:
+            return False
+        read += count
+    return True
+
+
+def stream_frames(video_path, fps, width, height, keyframes_only=False):
+    '''Yields grayscale frames piped from ffmpeg, each one a view into the same reusable buffer'''
+    if keyframes_only:
+        # only keyframes are decoded, at whatever rate they occur
+        command = (
+            f'ffmpeg -v error -skip_frame nokey -i {video_path} -vf "scale={width}:{height}" '
+            f'-vsync passthrough -f rawvideo -pix_fmt gray -'
+        )
+    else:
+        command = (
+            f'ffmpeg -v error -i {video_path} -vf "fps={fps},scale={width}:{height}" '
+            f'-f rawvideo -pix_fmt gray -'
+        )
+    frame_size = width * height
+    buffer = bytearray(frame_size)
+    view = memoryview(buffer)
+    # zero-copy: the array shares memory with the buffer that readinto fills
+    frame = numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(height, width)
+
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+    try:
+        while read_frame(process.stdout, view, frame_size):
+            yield frame
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def seek_frames(video_path, timestamps, width, height):
+    '''Yields the grayscale frame at each timestamp, seeking to it instead of decoding up to it'''
+    frame_size = width * height
+    buffer = bytearray(frame_size)
+    view = memoryview(buffer)
+    frame = numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(height, width)
+
+    for timestamp in timestamps:
+        command = (
+            f'ffmpeg -v error -ss {timestamp:.3f} -i {video_path} -frames:v 1 '
+            f'-vf "scale={width}:{height}" -f rawvideo -pix_fmt gray -'
+        )
+        process = subprocess.run(command, shell=True, capture_output=True)
+        if len(process.stdout) < frame_size:
+            continue
+        view[:] = process.stdout[:frame_size]
+        yield timestamp, frame
+
+
+def spread_timestamps(duration, count):
+    '''Returns count timestamps that keep halving the gaps between earlier ones (1/2, 1/4, 3/4, 1/8, ...)'''
+    timestamps = []
+    denominator = 2
+    while len(timestamps) < count:
+        for numerator in range(1, denominator, 2):
+            timestamps.append(duration * numerator / denominator)
+            if len(timestamps) == count:
+                break
+        denominator *= 2
+    return timestamps
+
+
+def stream_batches(video_path, fps, width, height, size=batch_size):
+    '''Groups streamed frames into fresh (size, height, width) arrays that can be handed to other processes'''
+    batch = numpy.empty((size, height, width), dtype=numpy.uint8)
+    count = 0
+    for frame in stream_frames(video_path, fps, width, height):
+        batch[count] = frame
+        count += 1
+        if count == size:
+            yield batch
+            batch = numpy.empty((size, height, width), dtype=numpy.uint8)
+            count = 0
+    if count:
+        yield batch[:count]
+
+
+def find_faces(video_path, fps, workers=None):
+    (width, _), (scan_width, scan_height) = detection_resolution(video_path)
+    ratio = width / scan_width
+    # min_size is in source pixels, shrink it along with the frame
+    face_size = tuple(max(1, round(v / ratio)) for v in min_size)
+    workers = workers or os.cpu_count() or 1
+
+    print(f"Running tasks on {workers} worker(s)...")
+    start = time.time()
+    results = []
+    batches = stream_batches(video_path, fps, scan_width, scan_height)
+
+    if workers == 1:
+        for batch in batches:
+            results.extend(detect_batch(batch, face_size))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+            # futures are collected in submission order, which keeps frame order,
+            # and capping them bounds how many decoded batches are held in memory
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.submit(detect_batch, batch, face_size))
+                if len(pending) >= workers * 2:
+                    results.extend(pending.popleft().result())
+            while pending:
+                results.extend(pending.popleft().result())
 
+    end = time.time()
+    print(f"Finished OpenCV Tasks in {round(end - start, 2)} seconds")
+    return [[tuple(int(v * ratio) for v in face) for face in faces] for faces in results]
 
-async def detect_faces(frame_path):
-    frame = cv2.imread(frame_path)
-    if frame is None:
-        return []
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    cascade = cv2.CascadeClassifier(
-        'haarcascade/haarcascade_frontalface_alt2.xml')
-    faces = cascade.detectMultiScale(
-        gray, scaleFactor=scale_factor, minNeighbors=min_neighbors, minSize=min_size)
-    return faces
-
-
-async def find_faces(video_path, fps):
 
+def write_thumbnails(video_path, fps):
+    '''Writes full resolution thumbnails of the sampled frames into thumbs/'''
     PREFIX = os.path.join(os.getcwd(), "thumbs")
 
     print("Clearing directory...")
@@ -42,81 +204,92 @@ async def find_faces(video_path, fps):
 
     print("Generating images...")
     command = f'ffmpeg -i {video_path} -vf fps={fps} {PREFIX}/%d.jpg'
-    subprocess.run(command, shell=True)
+    tracer.run(command, 'write_thumbnails')
+    return [os.path.join(PREFIX, f) for f in os.listdir(PREFIX)]
 
-    frame_paths = [os.path.join(PREFIX, f) for f in os.listdir(PREFIX)]
 
-    print("Running tasks...")
-    start = time.time()
-    tasks = []
+def as_detections(points):
+    '''Accepts a detection array or a list of (x, y, w, h) boxes, returns a detection array'''
+    if isinstance(points, numpy.ndarray) and points.dtype == detection_dtype:
+        return points
+    detections = numpy.zeros(len(points), dtype=detection_dtype)
+    detections['frame'] = -1
+    detections['time'] = numpy.nan
+    if len(points):
+        boxes = numpy.asarray(points).reshape(-1, 4)
+        detections['x'], detections['y'], detections['w'], detections['h'] = boxes.T
+    return detections
 
-    for frame_path in frame_paths:
-        tasks.append(detect_faces(frame_path))
 
-    results = await asyncio.gather(*tasks)
-
-    end = time.time()
-    print(f"Finished OpenCV Tasks in {round(end - start, 2)} seconds")
-    return results
+def to_detections(results, fps):
+    '''Flattens per-frame face lists into a detection array, keeping each face's frame index and timestamp'''
+    frames = [i for i, faces in enumerate(results) for _ in faces]
+    detections = as_detections([face for faces in results for face in faces])
+    detections['frame'] = frames
+    detections['time'] = numpy.asarray(frames, dtype=float) / fps
+    return detections
 
 
 def point_median(points):
-    xs = [x for (x, _, _, _) in points]
-    ys = [y for (_, y, _, _) in points]
-    ws = [w for (_, _, w, _) in points]
-    hs = [h for (_, _, _, h) in points]
-    median_x = numpy.median(xs)
-    median_y = numpy.median(ys)
-    median_width = numpy.median(ws)
-    median_height = numpy.median(hs)
+    points = as_detections(points)
+    median_x = numpy.median(points['x'])
+    median_y = numpy.median(points['y'])
+    median_width = numpy.median(points['w'])
+    median_height = numpy.median(points['h'])
     return (median_x, median_y, median_width, median_height)
 
 
 def point_range(points):
-    xs = [x for (x, _, _, _) in points]
-    ys = [y for (_, y, _, _) in points]
-    ws = [w for (_, _, w, _) in points]
-    hs = [h for (_, _, _, h) in points]
-
-    min_x = min(xs)
-    min_y = min(ys)
-    max_x = max(xs)
-    max_y = max(ys)
-    min_w = min(ws)
-    min_h = min(hs)
-    max_w = max(ws)
-    max_h = max(hs)
-
-    return (min_x, min_y, max_x, max_y, min_w, min_h, max_w, max_h)
+    points = as_detections(points)
+    xs = points['x']
+    ys = points['y']
+    ws = points['w']
+    hs = points['h']
+    return (xs.min(), ys.min(), xs.max(), ys.max(), ws.min(), hs.min(), ws.max(), hs.max())
 
 
 def remove_outliers(points, iterations=1):
-    xs = [x for (x, _, _, _) in points]
-    ys = [y for (_, y, _, _) in points]
-    median_x, median_y, _, _ = point_median(points)
-    std_x = numpy.std(xs)
-    std_y = numpy.std(ys)
-
-    final = []
-
-    for (x, y, w, h) in points:
-        if abs(x - median_x) > std_x * iterations or abs(y - median_y) > std_y * iterations:
-            continue
-        final.append((x, y, w, h))
-
-    if iterations <= 1:
-        return final
-
-    return remove_outliers(final, iterations - 1)
-
-
-def facial_detection(video_path: str, fps: int):
-    loop = asyncio.get_event_loop()
-    results = loop.run_until_complete(find_faces(
-        video_path, fps))
-
-    points = [box for boxes in results for box in boxes]
-
+    points = as_detections(points)
+    # each pass tightens the cutoff by one standard deviation, from iterations down to 1
+    for cutoff in range(iterations, 0, -1):
+        if not len(points):
+            break
+        median_x, median_y, _, _ = point_median(points)
+        std_x = points['x'].std()
+        std_y = points['y'].std()
+        keep = (numpy.abs(points['x'] - median_x) <= std_x * cutoff) & (numpy.abs(points['y'] - median_y) <= std_y * cutoff)
+        points = points[keep]
+    return points
+
+
+def detections_path(video_path, fps):
+    '''Returns the sidecar file for the detections of video_path made with the current settings'''
+    key = cache_key(file_hash(video_path), scale_factor, min_neighbors, min_size, detection_width, fps)
+    return f'{video_path}.{key[:16]}.faces.npz'
+
+
+def detect_video(video_path, fps, workers=None):
+    '''Returns the detections for video_path, loading them from its sidecar when they were already computed'''
+    sidecar = detections_path(video_path, fps)
+    if os.path.exists(sidecar):
+        with numpy.load(sidecar) as data:
+            detections = data['detections']
+        print(f"Loaded {len(detections)} detections from {sidecar}")
+        return detections
+
+    detections = to_detections(find_faces(video_path, fps, workers), fps)
+    # write then rename, so an interrupted run never leaves a truncated sidecar behind
+    temp_sidecar = temp_path(sidecar)
+    with open(temp_sidecar, 'wb') as f:
+        numpy.savez(f, detections=detections)
+    os.replace(temp_sidecar, sidecar)
+    return detections
+
+
+def facecam_box(points):
+    '''Turns face detections into the x, y, x2, y2 of a facecam box that covers them'''
+    if not len(points):
+        raise ValueError("No faces found")
     filtered_points = remove_outliers(points, iterations=3)
 
     min_x, min_y, max_x, _, _, _, max_w, max_h = point_range(filtered_points)
@@ -133,6 +306,160 @@ def facial_detection(video_path: str, fps: int):
     return (math.floor(cam_box_x), math.floor(cam_box_y), math.floor(cam_box_x2), math.floor(cam_box_y2))
 
 
+@traced()
+def facial_detection(video_path: str, fps: int, workers: int = None):
+    detections = detect_video(video_path, fps, workers)
+    return facecam_box(detections)
+
+
+@traced()
+def adaptive_facial_detection(video_path: str, tolerance: float = 0.01, min_frames: int = 5, max_frames: int = 60, patience: int = 3, keyframes: bool = False):
+    '''Samples frames until the facecam box stops moving by more than tolerance (a fraction of the frame width).
+    Returns the box and the number of frames it took'''
+    (width, _), (scan_width, scan_height) = detection_resolution(video_path)
+    ratio = width / scan_width
+    face_size = tuple(max(1, round(v / ratio)) for v in min_size)
+
+    if keyframes:
+        frames = stream_frames(video_path, None, scan_width, scan_height, keyframes_only=True)
+    else:
+        timestamps = spread_timestamps(extract_duration(video_path), max_frames)
+        frames = (frame for _, frame in seek_frames(video_path, timestamps, scan_width, scan_height))
+
+    start = time.time()
+    points = []
+    box = None
+    stable = 0
+    used = 0
+
+    for gray in frames:
+        used += 1
+        points.extend(tuple(int(v * ratio) for v in face) for face in detect_faces(gray, face_size))
+        if used >= min_frames and points:
+            estimate = facecam_box(points)
+            if box is not None and max(abs(a - b) for a, b in zip(estimate, box)) <= tolerance * width:
+                stable += 1
+            else:
+                stable = 0
+            box = estimate
+            if stable >= patience:
+                break
+        if used >= max_frames:
+            break
+
+    if hasattr(frames, 'close'):
+        frames.close()
+    if box is None and points:
+        # the clip ran out of frames before min_frames, e.g. a short clip sampled at its keyframes
+        box = facecam_box(points)
+    if box is None:
+        raise ValueError(f"No faces found in {video_path}")
+
+    end = time.time()
+    print(f"Facecam box settled after {used} frames in {round(end - start, 2)} seconds")
+    return box, used
+
+
+def pick_face(faces, previous=None):
+    '''Picks the face closest to the previous box, or the largest one when there is nothing to follow'''
+    if previous is None:
+        return max(faces, key=lambda face: face[2] * face[3])
+    px = previous[0] + previous[2] / 2
+    py = previous[1] + previous[3] / 2
+    return min(faces, key=lambda face: (face[0] + face[2] / 2 - px) ** 2 + (face[1] + face[3] / 2 - py) ** 2)
+
+
+def match_face(gray, template, box):
+    '''Looks for the template around its last box, returns the new box or None when the match is too weak'''
+    x, y, w, h = box
+    frame_height, frame_width = gray.shape
+    left = max(0, x - w // 2)
+    top = max(0, y - h // 2)
+    right = min(frame_width, x + w + w // 2)
+    bottom = min(frame_height, y + h + h // 2)
+    window = gray[top:bottom, left:right]
+    if window.shape[0] < h or window.shape[1] < w:
+        return None
+    scores = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+    _, score, _, (dx, dy) = cv2.minMaxLoc(scores)
+    if score < track_threshold:
+        return None
+    return (left + dx, top + dy, w, h)
+
+
+def track_faces(video_path, fps, keyframe_interval=10):
+    '''Runs the cascade every keyframe_interval sampled frames and template-tracks the face in between.
+    Returns one box (or None when lost) per sampled frame, in source pixels'''
+    (width, _), (scan_width, scan_height) = detection_resolution(video_path)
+    ratio = width / scan_width
+    face_size = tuple(max(1, round(v / ratio)) for v in min_size)
+
+    print("Tracking faces...")
+    start = time.time()
+    boxes = []
+    box = None
+    template = None
+    detections = 0
+
+    for i, gray in enumerate(stream_frames(video_path, fps, scan_width, scan_height)):
+        found = None
+        if i % keyframe_interval == 0:
+            detections += 1
+            faces = detect_faces(gray, face_size)
+            if faces:
+                found = pick_face(faces, box)
+                x, y, w, h = found
+                template = gray[y:y + h, x:x + w].copy()
+        if found is None and template is not None:
+            found = match_face(gray, template, box)
+        if found is not None:
+            box = found
+        boxes.append(found)
+
+    end = time.time()
+    print(f"Tracked {len(boxes)} frames with {detections} detections in {round(end - start, 2)} seconds")
+    return [None if b is None else tuple(int(v * ratio) for v in b) for b in boxes]
+
+
+def smooth_path(values, window):
+    '''Fills gaps (NaN) by interpolation and applies a centered moving average'''
+    values = numpy.asarray(values, dtype=float)
+    index = numpy.arange(len(values))
+    known = ~numpy.isnan(values)
+    values = numpy.interp(index, index[known], values[known])
+    if window <= 1:
+        return values
+    radius = window // 2
+    kernel = numpy.ones(2 * radius + 1) / (2 * radius + 1)
+    return numpy.convolve(numpy.pad(values, radius, mode='edge'), kernel, mode='valid')
+
+
+@traced()
+def facecam_path(video_path: str, fps: int, keyframe_interval: int = 10, smoothing: int = 5):
+    '''Returns the w, h of a fixed size facecam box and a list of (time, x, y) that follows the face'''
+    width, height = extract_resolution(video_path)
+    boxes = track_faces(video_path, fps, keyframe_interval)
+    found = [b for b in boxes if b is not None]
+    if not found:
+        raise ValueError(f"No faces found in {video_path}")
+
+    face_w = numpy.median([b[2] for b in found])
+    face_h = numpy.median([b[3] for b in found])
+    xs = smooth_path([numpy.nan if b is None else b[0] for b in boxes], smoothing)
+    ys = smooth_path([numpy.nan if b is None else b[1] for b in boxes], smoothing)
+
+    # same framing around the face as facial_detection, with one face instead of a range
+    cam_w = face_w + 2 * (face_w / 1.5)
+    cam_h = cam_w * 0.75
+    cam_w = min(math.floor(cam_w), width)
+    cam_h = min(math.floor(cam_h), height)
+    cam_xs = numpy.clip(xs - face_w / 1.5, 0, width - cam_w)
+    cam_ys = numpy.clip(ys - face_h / 4, 0, height - cam_h)
+
+    path = [(i / fps, math.floor(x), math.floor(y)) for i, (x, y) in enumerate(zip(cam_xs, cam_ys))]
+    return cam_w, cam_h, path
+
+
 def draw_box(image_path: str, x: int, y: int, x2: int, y2: int):
     # load image from image path using opencv
     image = cv2.imread(image_path)
@@ -1,29 +1,70 @@
+import contextlib
+import functools
+import json
 import os
-import re
-import unicodedata
+import uuid
+from functools import partial
 
 import fire
 
-from dl import download
-from facial_detection import facial_detection, draw_box
-from render import crop_video, extract_resolution, blur_video, create_mobile_video
-from tts import generate_voiceover_with_captions, merge_voiceover_with_video_audio
+# only light modules are imported here, OpenCV, yt-dlp and the TTS stack are imported by the commands that use them
+
+from batch import run_batch
+from cache import MediaCache
+from encoders import encoder_args
+from library import MediaLibrary, cut_range, sanitize_title
+from render import crop_video, crop_video_path, extract_resolution, blur_video, create_mobile_video, render_mobile_video, render_variants, composite_size, cached_crop_layers, background_crop, DRAFT_WIDTH, DRAFT_HEIGHT, BLUR_QUALITY
+from pipeline import Pipeline
+from segments import render_segmented
+from tracing import tracer
+
+
+
+@functools.lru_cache(maxsize=8)
+def sanitized_listing(folder: str, mtime_ns: int) -> tuple:
+    '''The folder's file names with their sanitized form, listed again only when the folder changes'''
+    return tuple((filename, sanitize_title(filename)) for filename in os.listdir(folder))
 
 
 class TikTokGenerator:
-    def detect(self, path: str, fps: int = 1, box: bool = False):
-        x, y, x2, y2 = facial_detection(path, fps)
+    def __init__(self, target: str = 'quality', encoder: str = None, threads: int = None):
+        '''target picks the encoder profile (quality, throughput or size), encoder asks for a specific ffmpeg encoder
+        and threads caps its thread count. They apply to every command and fall back to what this machine can run'''
+        self.target = target
+        self.encoder = encoder
+        self.threads = threads
+
+    def _codec_args(self, target: str = None) -> str:
+        return encoder_args(target or self.target, self.encoder, self.threads)
+
+    def _facecam_box(self, path, fps, workers, adaptive, keyframes):
+        from facial_detection import facial_detection, adaptive_facial_detection
+        if adaptive or keyframes:
+            # stop sampling as soon as the box settles instead of decoding the whole video
+            box, _ = adaptive_facial_detection(path, keyframes=keyframes)
+            return box
+        return facial_detection(path, fps, workers)
+
+    def detect(self, path: str, fps: int = 1, box: bool = False, workers: int = None, adaptive: bool = False, keyframes: bool = False):
+        x, y, x2, y2 = self._facecam_box(path, fps, workers, adaptive, keyframes)
         print(f"Top Left: {x} {y}")
         print(f"Bottom Right: {x2} {y2}")
         if box:
-            for image_path in os.listdir('thumbs'):
-                draw_box(f'thumbs/{image_path}', x, y, x2, y2)
+            from facial_detection import draw_box, write_thumbnails
+            for image_path in write_thumbnails(path, fps):
+                draw_box(image_path, x, y, x2, y2)
 
-    def crop_face(self, path: str, fps: int = 1):
-        x, y, x2, y2 = facial_detection(path, fps)
+    def crop_face(self, path: str, fps: int = 1, workers: int = None, track: bool = False, keyframe_interval: int = 10, smoothing: int = 5, adaptive: bool = False, keyframes: bool = False):
+        if track:
+            # the crop follows the face instead of covering everywhere it has been
+            from facial_detection import facecam_path
+            w, h, face_path = facecam_path(path, fps, keyframe_interval, smoothing)
+            crop_video_path(path, 'output.mp4', w, h, face_path, codec_args=self._codec_args())
+            return
+        x, y, x2, y2 = self._facecam_box(path, fps, workers, adaptive, keyframes)
         w = x2 - x
         h = y2 - y
-        crop_video(path, 'output.mp4', x, y, w, h)
+        crop_video(path, 'output.mp4', x, y, w, h, codec_args=self._codec_args())
 
     def crop_box(self, path: str):
         width, height = extract_resolution(path)
@@ -32,51 +73,89 @@ class TikTokGenerator:
         y = 0
         w = height
         h = height
-        crop_video(path, 'output.mp4', x, y, w, h)
+        crop_video(path, 'output.mp4', x, y, w, h, codec_args=self._codec_args())
 
     def blur(self, path: str, blur: int = 15):
-        blur_video(path, 'output.mp4', blur)
+        blur_video(path, 'output.mp4', blur, codec_args=self._codec_args())
 
     def is_text1_in_filenames(self, text1: str = None, folder='.'):
+        text1_sanitized = sanitize_title(text1)
+        if not text1_sanitized:
+            # an empty title is in every file name
+            return False, None
+        for filename, sanitized in sanitized_listing(folder, os.stat(folder).st_mtime_ns):
+            if text1_sanitized in sanitized:
+                return True, filename
+        return False, None
 
-        def sanitize(text):
-            if not text:
-                return ''
-            # Normalize Unicode (e.g., full-width to ASCII)
-            text = unicodedata.normalize('NFKC', text)
-            # Replace forbidden/unsafe characters with _
-            return re.sub(r'[\\/:*?"<>|&\s]', '_', text)
+    def _rename_unsafe(self, path):
+        # ffmpeg commands are built as shell strings, so file names can't have spaces or shell characters
+        invalid_chars = [':', '：', ' ', '&', '|']
+        for char in invalid_chars:
+            if char in path:
+                new_path = path.replace(char, '_')
+                os.rename(path, new_path)
+                path = new_path
+        return path
 
-        text1_sanitized = sanitize(text1)
+    def _library(self, job):
+        if not job['library_dir']:
+            return None
+        return MediaLibrary(job['library_dir'], int(job['library_budget_gb'] * 1024 ** 3), job['library_days'])
 
-        for filename in os.listdir(folder):
-            if text1_sanitized in sanitize(filename):
-                return True, filename
-        return False, None
+    def _source_range(self, job, path, held=None):
+        '''Cuts the job's start/end out of a file holding the (start, end) part of the source given by held,
+        None for all of it'''
+        start, end = job['start'], job['end']
+        if (start is None and end is None) or held == (start, end):
+            return path
+        offset = held[0] if held else 0
+        # batch jobs can share an output name and cut from the same file at once
+        return cut_range(path, f"{job['output']}_source.{uuid.uuid4().hex[:8]}.mp4", start - offset, None if end is None else end - offset)
 
-    def generate(self, path: str, output: str = 'output', text1: str=None , text2:str =None, text3:str =None, delay:float = 3.0, blur: int = 20, width=2160, height=3840, fps: int = 60, cookies: str = None):
-        exists, matched_file = self.is_text1_in_filenames(text1)
-        if exists:
-            print(f"File found matching text1: {matched_file}")
-            path = matched_file
-            invalid_chars = [':', '：', ' ', '&', '|']
-            for char in invalid_chars:
-                if char in path:
-                    new_path = path.replace(char, '_')
-                    os.rename(path, new_path)
-                    path = new_path
-        else:
+    def _prepare_source(self, job):
+        '''Returns the job's source: a file in the media library, a file matching text1, or a download'''
+        path, text1, library = job['path'], job['source_text'], self._library(job)
+        url = path if path.startswith('http') else None
+        with library.lock(url or path) if library else contextlib.nullcontext():
+            entry = library and library.find(url, text1, job['source_height'], job['start'], job['end'])
+            if entry:
+                print(f"Found {entry['path']} in the media library")
+                held = None if entry['start'] is None else (entry['start'], entry['end'])
+                return self._source_range(job, entry['path'], held)
+            exists, matched_file = self.is_text1_in_filenames(text1)
+            if exists:
+                print(f"File found matching text1: {matched_file}")
+                return self._source_range(job, self._rename_unsafe(matched_file))
             print("No file matching text1 found.")
-            if path.startswith('http'):
-                path = download(path, '.', cookies=cookies)
-                # if there is a space in the filename, rename
-                invalid_chars = [':', '：', ' ', '&', '|']
-                for char in invalid_chars:
-                    if char in path:
-                        new_path = path.replace(char, '_')
-                        os.rename(path, new_path)
-                        path = new_path
+            if not url:
+                return self._source_range(job, path)
+            from dl import download
+            path = download(url, library.directory if library else '.', cookies=job['cookies'], min_height=job['source_height'], start=job['start'], end=job['end'])
+            # if there is a space in the filename, rename
+            path = self._rename_unsafe(path)
             print(f"Downloaded file path: {path}")
+            if library:
+                path = library.add(path, url=url, title=text1, target_height=job['source_height'], start=job['start'], end=job['end'])
+            return path
+
+    def _disposable(self, job, source):
+        '''Sources are deleted after rendering unless the media library keeps them'''
+        return not (job['library_dir'] and self._library(job).owns(source))
+
+    def _plan_job(self, path: str, output: str = 'output', text1: str=None , text2:str =None, text3:str =None, delay:float = 3.0, blur: int = 20, width=2160, height=3840, fps: int = 60, cookies: str = None, cache_dir: str = None, cache_budget_gb: float = 20, voice_cache_mb: float = 500, draft: bool = False, blur_quality: float = BLUR_QUALITY, segments: int = 1, verify: bool = False, variants=None, start: float = None, end: float = None, library_dir: str = None, library_budget_gb: float = 50, library_days: float = 30):
+        '''Normalizes generate's arguments into the settings its stages work from'''
+        source_text = text1
+        target = None
+        # the content box is cut from the full height of the source and spans the output width,
+        # a draft still fetches for the full render that follows it
+        source_height = width
+        if end is not None and start is None:
+            start = 0.0
+        if draft:
+            # same composition at a fraction of the pixels, the layout scales with the frame
+            width, height = DRAFT_WIDTH, DRAFT_HEIGHT
+            target = 'draft'
         if height % 2 != 0:
             height -= 1
         if width % 2 != 0:
@@ -88,10 +167,6 @@ class TikTokGenerator:
                 if char in output:
                     output = output.replace(char, '_')
 
-            background = f'{output}_background.mp4'
-            box = f'{output}_box.mp4'
-            intermediate_output = f'{output}_premerge.mp4'
-
             invalid_chars = [':', '：']
             for char in invalid_chars:
                 if char in text1:
@@ -101,59 +176,134 @@ class TikTokGenerator:
             text1 = None
             text2 = None
             text3 = None
-            background = 'test_background.mp4'
-            box = 'test_box.mp4'
-            intermediate_output = 'test_premerge.mp4'
-        # get background
-        if(not os.path.exists(background)):
-            bg_width, bg_height = extract_resolution(path)
-            h = bg_height
-            w = int(bg_height * 0.5625)  # 9/16 in decimal
-            x = (bg_width - w) / 2
-            y = 0
-            crop_video(path, background, x, y, w, h, width, height)
-        # get box
-        if(not os.path.exists(box)):
-            square_size = min(bg_width, bg_height)
-            x = (bg_width - square_size) // 2
-            y = (bg_height - square_size) // 2
-            box_width = 2160
-            box_height = 2160
-            crop_video(path, box, x, y, square_size, square_size, box_width, box_height)
-        voice_path = None
-        captions = None
-        if text3 and text3.strip():
-            voice_path = f"{output}_voice.mp3"
-            voice_captions =f"{output}_captions.srt"
-            if(not os.path.exists(voice_path)):
-                voice_path, captions = generate_voiceover_with_captions(text3, audio_path=voice_path, srt_path=voice_captions, delay=delay)
-
-        create_mobile_video(
-            background_file=background,
-            content_file=box,
-            output_file=intermediate_output,
-            overlay_text_top=text1,
-            overlay_text_bottom=text2,
+
+        # the narration is kept in memory, it never becomes a file next to the output
+        narrate = bool(text3 and text3.strip())
+        if draft:
+            output += '_draft'
+            # a draft is a single quick preview
+            variants = None
+        variants = self._variants(variants, output)
+        if variants and segments > 1:
+            raise ValueError('--variants and --segments can not be combined, variants already share one render')
+        if variants:
+            # the composite is built at the largest size, so the crop layers are too
+            width, height = composite_size(variants)
+            source_height = width
+
+        return {
+            'path': path, 'source_text': source_text, 'cookies': cookies, 'output': output,
+            'text1': text1, 'text2': text2, 'text3': text3, 'narrate': narrate,
+            'delay': delay, 'blur': blur, 'blur_quality': blur_quality, 'width': width, 'height': height, 'fps': fps, 'codec_args': self._codec_args(target), 'draft': draft,
+            'segments': segments, 'verify': verify, 'variants': variants,
+            'cache_dir': cache_dir, 'cache_budget_gb': cache_budget_gb, 'voice_cache_mb': voice_cache_mb,
+            'start': start, 'end': end, 'source_height': source_height,
+            'library_dir': library_dir, 'library_budget_gb': library_budget_gb, 'library_days': library_days,
+        }
+
+    def _variants(self, variants, output):
+        '''Parses variant specs like "1080x1920" or "1080x1920:throughput" (a comma separated string or a list)
+        into (output_file, width, height, codec_args) tuples'''
+        if not variants:
+            return []
+        if isinstance(variants, str):
+            variants = variants.split(',')
+        parsed = []
+        for spec in variants:
+            size, _, target = str(spec).strip().partition(':')
+            width, height = (int(value) for value in size.lower().split('x'))
+            width -= width % 2
+            height -= height % 2
+            parsed.append((f'{output}_{width}x{height}.mp4', width, height, self._codec_args(target or None)))
+        return parsed
+
+    def _outputs(self, job):
+        '''Returns every video file the job writes'''
+        if job['variants']:
+            return [output_file for output_file, _, _, _ in job['variants']]
+        return [f"{job['output']}.mp4"]
+
+    def _crop_layers(self, job, source):
+        # the crops only depend on the source and the output size, so new titles or blur reuse them
+        cache = MediaCache(os.path.join(job['cache_dir'], 'layers'), int(job['cache_budget_gb'] * 1024 ** 3))
+        return cached_crop_layers(source, cache, job['width'], job['height'], blur_quality=job['blur_quality'])
+
+    def _narration(self, job):
+        '''Returns the narration task for the job, or None when there is nothing to narrate'''
+        if not job['narrate']:
+            return None
+        voice_cache = None
+        if job['cache_dir']:
+            voice_cache = MediaCache(os.path.join(job['cache_dir'], 'voice'), int(job['voice_cache_mb'] * 1024 ** 2), suffix='.f32', sidecars=('.json',))
+        from tts import generate_voiceover_with_captions
+        return partial(generate_voiceover_with_captions, job['text3'], delay=job['delay'], cache=voice_cache)
+
+    def _render(self, job, source, layers=None, narration=None):
+        voiceover_file, captions = narration or (None, None)
+        composition = dict(
+            overlay_text_top=job['text1'],
+            overlay_text_bottom=job['text2'],
             captions=captions,
-            blur_strength=blur,
-            fps=fps,
-            voiceover_file=None
+            blur_strength=job['blur'],
+            blur_quality=job['blur_quality'],
+            fps=job['fps'],
+            voiceover_file=voiceover_file,
+            delay=job['delay'],
+            layers=layers
         )
-        if voice_path:
-            merge_voiceover_with_video_audio(intermediate_output, voice_path, f'{output}.mp4', delay=delay)
-            os.remove(intermediate_output)
-        else:
-            os.rename(intermediate_output, f'{output}.mp4')
-        
-        os.remove(background)
-        os.remove(box)
-        os.remove(path)
-        if voice_path:
-            os.remove(voice_path)
-        if text3:
-            os.remove(voice_captions)
-
-    def blur_box(self, path: str, output: str = 'output', blur: int = 20, width=1080, height=1920, fps: int = 60):
+        if job['variants']:
+            # decoded and composited once, then split into every output size
+            render_variants(source, job['variants'], **composition)
+            return
+        render = render_mobile_video
+        if job['segments'] > 1:
+            # keyframe-aligned pieces of the clip render side by side and are joined without re-encoding
+            render = partial(render_segmented, segments=job['segments'], verify=job['verify'])
+        # crop, blur, overlay, text and voiceover mix all happen in one ffmpeg pass
+        render(
+            source,
+            f"{job['output']}.mp4",
+            width=job['width'],
+            height=job['height'],
+            codec_args=job['codec_args'],
+            **composition
+        )
+
+    def _cleanup(self, job, source=None):
+        if source and self._disposable(job, source):
+            os.remove(source)
+
+    def generate(self, path: str, output: str = 'output', text1: str=None , text2:str =None, text3:str =None, delay:float = 3.0, blur: int = 20, width=2160, height=3840, fps: int = 60, cookies: str = None, cache_dir: str = None, cache_budget_gb: float = 20, voice_cache_mb: float = 500, draft: bool = False, blur_quality: float = BLUR_QUALITY, segments: int = 1, verify: bool = False, variants=None, start: float = None, end: float = None, library_dir: str = None, library_budget_gb: float = 50, library_days: float = 30, trace: str = None):
+        if trace:
+            # Chrome trace of the job, open it in chrome://tracing or ui.perfetto.dev
+            tracer.enable()
+        job = self._plan_job(path, output, text1, text2, text3, delay, blur, width, height, fps, cookies, cache_dir, cache_budget_gb, voice_cache_mb, draft, blur_quality, segments, verify, variants, start, end, library_dir, library_budget_gb, library_days)
+
+        # the narration doesn't need the video, so it runs next to the download and crops
+        pipeline = Pipeline()
+        pipeline.add('source', lambda: self._prepare_source(job))
+        if cache_dir:
+            pipeline.add('layers', lambda source: self._crop_layers(job, source), deps=('source',))
+        narration = self._narration(job)
+        if narration:
+            # TTS and Whisper run in their own process so they don't hold up the ffmpeg stages
+            pipeline.add('narration', narration, process=True)
+        pipeline.add('render', lambda **results: self._render(job, **results), deps=tuple(pipeline.stages))
+
+        results = pipeline.run()
+        pipeline.report()
+        # a draft is followed by the full render, which needs the source again
+        self._cleanup(job, None if job['draft'] else results['source'])
+        if trace:
+            tracer.write(trace)
+
+    def batch(self, jobs: str, results: str = 'results.jsonl', download_workers: int = 2, crop_workers: int = 2, narration_workers: int = 1, encode_workers: int = 1, queue_size: int = 2, trace_dir: str = None):
+        '''Renders every job in a JSONL manifest (one line of generate arguments per job) with the stages pipelined across jobs'''
+        with open(jobs, encoding='utf-8') as f:
+            manifest = [json.loads(line) for line in f if line.strip()]
+        run_batch(self, manifest, results, download_workers, crop_workers, narration_workers, encode_workers, queue_size, trace_dir)
+
+    def blur_box(self, path: str, output: str = 'output', blur: int = 20, width=1080, height=1920, fps: int = 60, blur_quality: float = BLUR_QUALITY):
         '''Takes a square video, blurs it, makes it 9:16, then add the original video on top of it'''
         if height % 2 != 0:
             height -= 1
@@ -162,18 +312,35 @@ class TikTokGenerator:
         background = f'{output}_background.mp4'
         # get background
         bg_width, bg_height = extract_resolution(path)
-        h = bg_height
-        w = int(bg_height * 0.5625)  # 9/16 in decimal
-        x = (bg_width - w) / 2
-        y = 0
+        x, y, w, h = background_crop(bg_width, bg_height)
         if not os.path.exists(background):
-            crop_video(path, background, x, y, w, h, width, height)
+            crop_video(path, background, x, y, w, h, width, height, codec_args=self._codec_args('intermediate'))
         # no need to get the center 1:1 content of the video
         # since its already a square
         create_mobile_video(background, path, None,
-                            f'{output}.mp4', blur_strength=blur, fps=fps)
+                            f'{output}.mp4', blur_strength=blur, fps=fps, blur_quality=blur_quality, codec_args=self._codec_args())
         os.remove(background)
 
+    def highlights(self, path: str, count: int = 5, length: int = 45, manifest: str = None, cookies: str = None, output: str = None):
+        '''Finds the count loudest, busiest non-overlapping length second stretches of a long VOD from its audio,
+        streamed without downloading the video. Prints them as --start/--end cuts for generate, and with manifest
+        appends them as batch jobs rendering to {output}_{start}-{end}.mp4, output defaulting to the VOD's name'''
+        from highlights import find_highlights
+        source = path
+        if path.startswith('http'):
+            from dl import media_url
+            # quoted, direct media URLs carry query strings
+            source = f'"{media_url(path, cookies=cookies)}"'
+        cuts = find_highlights(source, count, length)
+        for rank, (start, end, score) in enumerate(cuts, start=1):
+            print(f"{rank}. {start // 3600:02}:{start % 3600 // 60:02}:{start % 60:02} score {score}: --start {start} --end {end}")
+        if manifest:
+            stem = output or ('highlight' if path.startswith('http') else sanitize_title(os.path.splitext(os.path.basename(path))[0]))
+            with open(manifest, 'a', encoding='utf-8') as f:
+                for start, end, _ in cuts:
+                    f.write(json.dumps({'path': path, 'start': start, 'end': end, 'output': f'{stem}_{start}-{end}'}) + '\n')
+            print(f"Added {len(cuts)} jobs to {manifest}")
+
     def extract(self, input_file: str):
         '''Extracts the center 9:16 portion of the video'''
         width, height = extract_resolution(input_file)
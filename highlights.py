@@ -0,0 +1,132 @@
+import heapq
+import math
+import subprocess
+from collections import deque
+
+import numpy
+
+# speech, laughs and cheers are well inside 4 kHz, and a low rate keeps decoding cheap
+ANALYSIS_RATE = 8000
+FRAME_SIZE = 200  # 25 ms, 40 frames a second
+FFT_SIZE = 256
+CHUNK_SECONDS = 60
+# how far back the "normal" level of the stream reaches, in seconds
+BASELINE_SECONDS = 300
+SILENCE_DB = -100.0
+# average of the loudness and onset scores over a window, in standard deviations above the stream's normal level
+MIN_SCORE = 1.0
+
+
+class Baseline:
+    '''Exponential moving mean and variance of a per-second feature, the stream's recent normal level'''
+
+    def __init__(self, seconds: float, floor: float):
+        self.alpha = 1 / seconds
+        self.floor = floor
+        self.mean = None
+        self.var = None
+
+    def scores(self, values):
+        '''Returns how unusual each value is against the level before it, updating the level as it goes'''
+        if self.mean is None:
+            # seeded from the whole first chunk, robustly, so a quiet intro or a loud first second doesn't make
+            # the stream's first minutes stand out while the level catches up
+            self.mean = float(numpy.median(values))
+            spread = 1.4826 * float(numpy.median(numpy.abs(values - self.mean)))
+            self.var = max(spread, self.floor) ** 2
+        scores = numpy.empty(len(values))
+        for i, value in enumerate(values):
+            scores[i] = (value - self.mean) / max(math.sqrt(self.var), self.floor)
+            delta = value - self.mean
+            self.mean += self.alpha * delta
+            self.var = (1 - self.alpha) * (self.var + self.alpha * delta * delta)
+        return scores
+
+
+def stream_audio(path: str, chunk_seconds: int = CHUNK_SECONDS, rate: int = ANALYSIS_RATE):
+    '''Yields the audio of path as mono float32 chunks of chunk_seconds, decoded by ffmpeg into one reused buffer.
+    Callers must be done with a chunk before asking for the next one'''
+    cmd = f'ffmpeg -v error -nostdin -i {path} -vn -ac 1 -ar {rate} -f f32le pipe:1'
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+    buffer = numpy.empty(chunk_seconds * rate, dtype=numpy.float32)
+    view = memoryview(buffer).cast('B')
+    try:
+        while True:
+            filled = 0
+            while filled < len(view):
+                read = process.stdout.readinto(view[filled:])
+                if not read:
+                    break
+                filled += read
+            # only whole seconds, the features are per second
+            seconds = filled // (rate * 4)
+            if seconds:
+                yield buffer[:seconds * rate]
+            if filled < len(view):
+                break
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+class AudioFeatures:
+    '''Per-second loudness (dB) and onset strength (spectral flux) of consecutive chunks'''
+
+    def __init__(self):
+        self.window = numpy.hanning(FRAME_SIZE).astype(numpy.float32)
+        # the last frame's spectrum, so the flux carries across chunks
+        self.previous = None
+
+    def __call__(self, samples):
+        frames = samples.reshape(-1, FRAME_SIZE)
+        energy = numpy.mean(frames * frames, axis=1)
+        spectrum = numpy.log1p(100 * numpy.abs(numpy.fft.rfft(frames * self.window, FFT_SIZE, axis=1)))
+        previous = spectrum[:1] if self.previous is None else self.previous
+        flux = numpy.maximum(numpy.diff(spectrum, axis=0, prepend=previous), 0).sum(axis=1)
+        self.previous = spectrum[-1:]
+        per_second = ANALYSIS_RATE // FRAME_SIZE
+        loudness = 10 * numpy.log10(energy.reshape(-1, per_second).mean(axis=1) + 10 ** (SILENCE_DB / 10))
+        onsets = flux.reshape(-1, per_second).mean(axis=1)
+        return loudness, onsets
+
+
+def find_highlights(path: str, count: int = 5, length: int = 45, chunk_seconds: int = CHUNK_SECONDS) -> list:
+    '''Returns up to count non-overlapping (start, end, score) stretches of length seconds where the audio is
+    loudest and busiest relative to the rest of the stream, best first. Memory doesn't grow with the stream'''
+    features = AudioFeatures()
+    loudness_baseline = Baseline(BASELINE_SECONDS, floor=3.0)
+    onset_baseline = Baseline(BASELINE_SECONDS, floor=1.0)
+    recent = deque(maxlen=length)
+    total = 0.0
+    best = None
+    top = []
+    second = 0
+
+    def keep(candidate):
+        if len(top) < count:
+            heapq.heappush(top, candidate)
+        else:
+            heapq.heappushpop(top, candidate)
+
+    for samples in stream_audio(path, chunk_seconds):
+        loudness, onsets = features(samples)
+        scores = loudness_baseline.scores(loudness) + onset_baseline.scores(onsets)
+        for score in scores:
+            if len(recent) == length:
+                total -= recent[0]
+            recent.append(score)
+            total += score
+            second += 1
+            if len(recent) < length:
+                continue
+            start = second - length
+            # of overlapping windows only the best one is a candidate
+            if best and start >= best[1] + length:
+                keep(best)
+                best = None
+            if best is None or total > best[0]:
+                best = (total, start)
+    if best:
+        keep(best)
+    # a stream with fewer stand-out moments than count yields fewer cuts, not its background
+    return [(start, start + length, round(total / length, 2)) for total, start in sorted(top, reverse=True) if total / length > MIN_SCORE]
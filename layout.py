@@ -0,0 +1,58 @@
+# the composition was designed for a 2160x3840 frame, everything else is scaled from it
+REFERENCE_WIDTH = 2160
+REFERENCE_HEIGHT = 3840
+
+# font size, x offset from center, top of the first line measured up from the bottom edge, line spacing
+TEXT_STYLES = {
+    'top': (230, 12, 3200, 200),
+    'bottom': (160, 10, 2980, 200),
+    'caption': (180, 12, 930, 0),
+}
+BORDER = 15
+
+
+class Layout:
+    '''Positions and sizes of the vertical composition for a given output frame'''
+
+    def __init__(self, width: int = REFERENCE_WIDTH, height: int = REFERENCE_HEIGHT):
+        self.width = width
+        self.height = height
+        self.scale_x = width / REFERENCE_WIDTH
+        self.scale_y = height / REFERENCE_HEIGHT
+        # sizes follow the tighter axis so text never outgrows the frame
+        self.scale = min(self.scale_x, self.scale_y)
+
+    def px(self, value: float) -> int:
+        return max(1, round(value * self.scale))
+
+    @property
+    def box_size(self) -> int:
+        # the 1:1 content box spans the full width
+        return self.width - self.width % 2
+
+    @property
+    def content_y(self) -> int:
+        return int((self.height - self.box_size) / 2)
+
+    @property
+    def border(self) -> int:
+        return self.px(BORDER)
+
+    def font_size(self, style: str) -> int:
+        return self.px(TEXT_STYLES[style][0])
+
+    def x_offset(self, style: str) -> int:
+        return self.px(TEXT_STYLES[style][1])
+
+    def line_y(self, style: str, line: int = 0) -> int:
+        '''Returns the top edge of a text line'''
+        _, _, from_bottom, spacing = TEXT_STYLES[style]
+        return self.height - round(from_bottom * self.scale_y) + round(line * spacing * self.scale)
+
+    def blur(self, strength: int) -> int:
+        '''Scales a blur radius given for the reference frame'''
+        return self.px(strength)
+
+    def blur_size(self, quality: float) -> tuple[int]:
+        '''Returns the even working size the background is blurred at, quality is the fraction of the output size'''
+        return (max(2, round(self.width * quality / 2) * 2), max(2, round(self.height * quality / 2) * 2))
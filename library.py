@@ -0,0 +1,172 @@
+import contextlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from cache import file_hash
+from probe import probe
+from tracing import tracer
+
+INDEX_FILE = 'index.sqlite'
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS media (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    content_hash TEXT UNIQUE,
+    height INTEGER,
+    -- the height the file was fetched for, a shorter file was the best the site had
+    target_height INTEGER,
+    -- the part of the source the file holds, NULL for all of it
+    start REAL,
+    "end" REAL,
+    size INTEGER NOT NULL,
+    added REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS aliases (
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    media_id INTEGER NOT NULL REFERENCES media(id) ON DELETE CASCADE,
+    PRIMARY KEY (kind, value, media_id)
+);
+'''
+
+# per-source locks shared by every MediaLibrary on the same directory, gen builds one per job
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def sanitize_title(text: str) -> str:
+    '''Normalizes a title or file name the way downloaded files are renamed, so the two can be compared'''
+    if not text:
+        return ''
+    # Normalize Unicode (e.g., full-width to ASCII)
+    text = unicodedata.normalize('NFKC', text)
+    # Replace forbidden/unsafe characters with _
+    return re.sub(r'[\\/:*?"<>|&\s]', '_', text)
+
+
+def covers(entry, start: float = None, end: float = None) -> bool:
+    '''Checks that the entry holds the part of its source from start to end, None meaning all of it or to the end'''
+    if entry['start'] is None:
+        return True
+    if start is None or entry['start'] > start:
+        return False
+    return entry['end'] is None or (end is not None and entry['end'] >= end)
+
+
+def cut_range(input_file: str, output_file: str, start: float = None, end: float = None) -> str:
+    '''Copies the [start, end) part of a file without re-encoding, cut at the keyframes like a ranged download'''
+    seek = f'-ss {start:.3f}' if start else ''
+    length = f'-t {end - (start or 0):.3f}' if end is not None else ''
+    tracer.run(f'ffmpeg -y -v error {seek} -i {input_file} {length} -map 0 -c copy {output_file}', 'cut_range', check=True)
+    return output_file
+
+
+class MediaLibrary:
+    '''SQLite index of the source videos kept on disk, found again by URL, title or content and pruned by size and age.
+    Files the library didn't download are never deleted by it'''
+
+    def __init__(self, directory: str = '.library', budget: int = 50 * 1024 ** 3, max_age_days: float = 30):
+        self.directory = directory
+        self.budget = budget
+        self.max_age = max_age_days * 24 * 3600
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        os.makedirs(directory, exist_ok=True)
+        with self._db() as db:
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _db(self):
+        # a connection per call, so worker threads never share one
+        db = sqlite3.connect(self.index_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA foreign_keys = ON')
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def lock(self, key: str) -> threading.Lock:
+        '''Returns the lock for a URL or title, so jobs for the same source fetch it once'''
+        with _locks_lock:
+            return _locks.setdefault((os.path.abspath(self.directory), key), threading.Lock())
+
+    def owns(self, path: str) -> bool:
+        return os.path.abspath(path).startswith(os.path.abspath(self.directory) + os.sep)
+
+    def find(self, url: str = None, title: str = None, min_height: int = 0, start: float = None, end: float = None):
+        '''Returns the smallest indexed file for the URL, or whose title contains title, that holds the range
+        at min_height or better. A title match is taken as it is, like a file the user put in place'''
+        clauses, params = [], []
+        if url:
+            clauses.append("(a.kind = 'url' AND a.value = ?)")
+            params.append(url)
+        if title and sanitize_title(title):
+            clauses.append("(a.kind = 'title' AND instr(a.value, ?) > 0)")
+            params.append(sanitize_title(title))
+        if not clauses:
+            return None
+        with self._db() as db:
+            rows = db.execute(
+                f'SELECT DISTINCT m.*, a.kind FROM media m JOIN aliases a ON a.media_id = m.id WHERE {" OR ".join(clauses)} ORDER BY m.size',
+                params,
+            ).fetchall()
+            for row in rows:
+                if not os.path.exists(row['path']):
+                    db.execute('DELETE FROM media WHERE id = ?', (row['id'],))
+                    continue
+                adequate = row['kind'] == 'title' or max(row['height'] or 0, row['target_height'] or 0) >= min_height
+                if adequate and covers(row, start, end):
+                    db.execute('UPDATE media SET last_used = ? WHERE id = ?', (time.time(), row['id']))
+                    return dict(row)
+        return None
+
+    def add(self, path: str, url: str = None, title: str = None, target_height: int = None, start: float = None, end: float = None) -> str:
+        '''Indexes a file under its URL and title and returns where it is kept. A file with the same contents as
+        one already indexed is deleted and the existing one is returned instead'''
+        path = os.path.abspath(path)
+        content_hash = file_hash(path)
+        now = time.time()
+        with self._db() as db:
+            row = db.execute('SELECT id, path FROM media WHERE content_hash = ?', (content_hash,)).fetchone()
+            if row and os.path.exists(row['path']) and row['path'] != path:
+                print(f"{path} is a copy of {row['path']}, keeping one")
+                os.remove(path)
+                media_id, path = row['id'], row['path']
+                db.execute('UPDATE media SET last_used = ? WHERE id = ?', (now, media_id))
+            else:
+                if row:
+                    db.execute('DELETE FROM media WHERE id = ?', (row['id'],))
+                media_id = db.execute(
+                    'INSERT OR REPLACE INTO media (path, content_hash, height, target_height, start, "end", size, added, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (path, content_hash, probe(path).height, target_height, start, end, os.path.getsize(path), now, now),
+                ).lastrowid
+            aliases = [('url', url), ('title', sanitize_title(title)), ('title', sanitize_title(os.path.splitext(os.path.basename(path))[0]))]
+            db.executemany(
+                'INSERT OR IGNORE INTO aliases (kind, value, media_id) VALUES (?, ?, ?)',
+                [(kind, value, media_id) for kind, value in aliases if value],
+            )
+        self.prune(keep=path)
+        return path
+
+    def prune(self, keep: str = None):
+        '''Deletes the library's files that weren't used within max_age, then the least recently used ones over budget'''
+        with self._db() as db:
+            rows = db.execute('SELECT id, path, size, last_used FROM media ORDER BY last_used').fetchall()
+            rows = [row for row in rows if self.owns(row['path'])]
+            total = sum(row['size'] for row in rows)
+            for row in rows:
+                if row['path'] == keep:
+                    continue
+                if total <= self.budget and time.time() - row['last_used'] <= self.max_age:
+                    break
+                if os.path.exists(row['path']):
+                    os.remove(row['path'])
+                db.execute('DELETE FROM media WHERE id = ?', (row['id'],))
+                total -= row['size']
+                print(f"Removed {row['path']} from the media library")
@@ -0,0 +1,48 @@
+import threading
+
+
+class ModelRegistry:
+    '''Loads each registered model once per process, either on first use or ahead of time on a background thread'''
+
+    def __init__(self):
+        self._loaders = {}
+        self._models = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, loader):
+        '''Registers a zero-argument function that builds the model'''
+        with self._lock:
+            self._loaders[name] = loader
+            self._locks.setdefault(name, threading.Lock())
+
+    def loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def get(self, name: str):
+        '''Returns the model, loading it if needed. Concurrent callers wait for a single load'''
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._locks[name]:
+            if name not in self._models:
+                print(f"Loading {name} model...")
+                self._models[name] = self._loaders[name]()
+            return self._models[name]
+
+    def preload(self, *names: str) -> threading.Thread:
+        '''Starts loading the given models on a daemon thread, so the load overlaps other work'''
+        def load():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    # get() retries on the caller's thread, where the error surfaces properly
+                    print(f"Background load of {name} failed: {e}")
+
+        thread = threading.Thread(target=load, name='model-preload', daemon=True)
+        thread.start()
+        return thread
+
+
+registry = ModelRegistry()
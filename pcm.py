@@ -0,0 +1,67 @@
+import subprocess
+
+# numpy is imported by the functions that do the math, so the render modules can import this one for free
+
+# raw little-endian float32 mono, the layout ffmpeg calls f32le
+PCM_FORMAT = 'f32le'
+
+
+class PcmAudio:
+    '''Mono float32 samples in -1..1 held in memory, handed to ffmpeg on stdin instead of through an audio file'''
+
+    def __init__(self, samples, sample_rate: int):
+        self.samples = samples
+        self.sample_rate = int(sample_rate)
+
+    @property
+    def duration(self) -> float:
+        return len(self.samples) / self.sample_rate
+
+    def input_args(self) -> str:
+        return f'-f {PCM_FORMAT} -ar {self.sample_rate} -ac 1 -i pipe:0'
+
+    def data(self) -> bytes:
+        return self.samples.astype('<f4', copy=False).tobytes()
+
+
+def from_int16(data: bytes, sample_rate: int) -> PcmAudio:
+    '''Wraps raw 16-bit little-endian PCM, as returned by TTS APIs, without going through ffmpeg'''
+    import numpy
+    return PcmAudio(numpy.frombuffer(data, '<i2').astype(numpy.float32) / 32768, sample_rate)
+
+
+def decode_audio(data: bytes, sample_rate: int = 24000) -> PcmAudio:
+    '''Decodes an encoded audio file held in memory (mp3, wav, ...) to mono float32 with one ffmpeg call'''
+    import numpy
+    cmd = f'ffmpeg -v error -i pipe:0 -f {PCM_FORMAT} -ac 1 -ar {sample_rate} pipe:1'
+    result = subprocess.run(cmd, shell=True, input=data, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg could not decode audio: {result.stderr.decode(errors='replace')}")
+    return PcmAudio(numpy.frombuffer(result.stdout, '<f4').copy(), sample_rate)
+
+
+def apply_gain(audio: PcmAudio, gain_db: float) -> PcmAudio:
+    '''Scales the samples by gain_db, clipping like a fixed-point export would'''
+    import numpy
+    samples = numpy.clip(audio.samples * numpy.float32(10 ** (gain_db / 20)), -1.0, 1.0)
+    return PcmAudio(samples, audio.sample_rate)
+
+
+def resample(audio: PcmAudio, sample_rate: int) -> PcmAudio:
+    '''Linear resampling, plenty for speech recognition, which is all it is used for'''
+    import numpy
+    if audio.sample_rate == sample_rate:
+        return audio
+    count = round(len(audio.samples) * sample_rate / audio.sample_rate)
+    positions = numpy.arange(count, dtype=numpy.float64) * (audio.sample_rate / sample_rate)
+    samples = numpy.interp(positions, numpy.arange(len(audio.samples)), audio.samples).astype(numpy.float32)
+    return PcmAudio(samples, sample_rate)
+
+
+def voiceover_input(voiceover) -> tuple:
+    '''Returns the ffmpeg input arguments for a voiceover file or PcmAudio, and the bytes to pipe to stdin'''
+    if not voiceover:
+        return '', None
+    if isinstance(voiceover, PcmAudio):
+        return voiceover.input_args(), voiceover.data()
+    return f'-i {voiceover}', None
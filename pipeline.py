@@ -0,0 +1,82 @@
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from tracing import call_traced, tracer
+
+
+class Stage:
+    def __init__(self, name: str, func, deps: tuple = (), process: bool = False):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        # model inference runs in a separate process, everything else waits on subprocesses or the network
+        self.process = process
+
+
+class Pipeline:
+    '''Runs stages as soon as their dependencies are done. Each stage gets its dependencies' results as keyword arguments'''
+
+    def __init__(self, max_threads: int = 4):
+        self.max_threads = max_threads
+        self.stages = {}
+        self.started = {}
+        self.finished = {}
+
+    def add(self, name: str, func, deps: tuple = (), process: bool = False):
+        self.stages[name] = Stage(name, func, deps, process)
+
+    def run(self) -> dict:
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        needs_process = any(stage.process for stage in self.stages.values())
+        start = time.time()
+        job = tracer.job()
+
+        # spawn rather than fork: the parent already has threads running and the child loads torch
+        with ThreadPoolExecutor(self.max_threads) as threads, ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) if needs_process else ThreadPoolExecutor(1) as processes:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if all(dep in results for dep in stage.deps):
+                        executor = processes if stage.process else threads
+                        self.started[name] = time.time() - start
+                        kwargs = {dep: results[dep] for dep in stage.deps}
+                        if stage.process and tracer.enabled:
+                            # a process stage traces itself and sends its events back with the result
+                            future = executor.submit(call_traced, f'stage {name}', job, stage.func, **kwargs)
+                        elif stage.process:
+                            # the tracer holds locks, so only plain picklable functions cross to the process
+                            future = executor.submit(stage.func, **kwargs)
+                        else:
+                            future = executor.submit(tracer.call, f'stage {name}', job, stage.func, **kwargs)
+                        running[future] = name
+                        del pending[name]
+                if not running:
+                    raise ValueError(f"Stages with unknown dependencies: {', '.join(pending)}")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+                    if self.stages[name].process and tracer.enabled:
+                        results[name], events = results[name]
+                        tracer.merge(events)
+                    self.finished[name] = time.time() - start
+        return results
+
+    def critical_path(self) -> list:
+        '''Returns the chain of stages that decided the total run time, from the first stage to the last'''
+        name = max(self.finished, key=self.finished.get)
+        path = [name]
+        while self.stages[name].deps:
+            name = max(self.stages[name].deps, key=self.finished.get)
+            path.append(name)
+        return path[::-1]
+
+    def report(self):
+        print("Stage timings:")
+        for name in sorted(self.finished, key=self.started.get):
+            print(f"  {name}: {self.started[name]:.2f}s -> {self.finished[name]:.2f}s ({self.finished[name] - self.started[name]:.2f}s)")
+        path = self.critical_path()
+        print(f"Critical path: {' -> '.join(path)} ({self.finished[path[-1]]:.2f}s)")
@@ -0,0 +1,87 @@
+import functools
+import json
+import os
+import statistics
+import subprocess
+from fractions import Fraction
+
+# keyframe_interval only reads this much of the file, enough for a few GOPs without scanning a long VOD
+KEYFRAME_SAMPLE_SECONDS = 30
+
+
+def file_signature(path: str) -> tuple:
+    '''A file is probed again only when its path, size or modification time changes'''
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def parse_rate(rate: str) -> float:
+    # ffprobe reports rates as fractions, 0/0 when it doesn't know
+    try:
+        return float(Fraction(rate))
+    except (ValueError, ZeroDivisionError, TypeError):
+        return 0.0
+
+
+class MediaInfo:
+    '''Stream metadata of a media file, read with a single ffprobe call'''
+
+    def __init__(self, path: str, data: dict):
+        self.path = path
+        streams = data.get('streams', [])
+        video = next((s for s in streams if s.get('codec_type') == 'video'), {})
+        audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+        self.width = int(video.get('width', 0))
+        self.height = int(video.get('height', 0))
+        self.video_codec = video.get('codec_name')
+        self.pix_fmt = video.get('pix_fmt')
+        self.fps = parse_rate(video.get('avg_frame_rate')) or parse_rate(video.get('r_frame_rate'))
+        self.duration = float(data.get('format', {}).get('duration') or video.get('duration') or 0)
+        self.has_audio = audio is not None
+        self.audio_codec = audio.get('codec_name') if audio else None
+        self.sample_rate = int(audio['sample_rate']) if audio and 'sample_rate' in audio else None
+        self.channels = audio.get('channels') if audio else None
+
+    @property
+    def size(self) -> tuple[int]:
+        return self.width, self.height
+
+    @property
+    def keyframe_interval(self) -> float:
+        '''Median seconds between keyframes over the start of the file, None with fewer than two keyframes'''
+        times = keyframe_times(self.path, KEYFRAME_SAMPLE_SECONDS)
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        return statistics.median(gaps) if gaps else None
+
+
+@functools.lru_cache(maxsize=256)
+def _probe(path: str, size: int, mtime_ns: int) -> MediaInfo:
+    cmd = f"ffprobe -v error -show_format -show_streams -of json {path}"
+    output = subprocess.run(cmd, shell=True, capture_output=True).stdout.decode()
+    try:
+        return MediaInfo(path, json.loads(output))
+    except json.JSONDecodeError:
+        raise RuntimeError(f"ffprobe could not read {path}")
+
+
+def probe(path: str) -> MediaInfo:
+    '''Returns the file's MediaInfo, probing it only the first time it is seen in this process'''
+    return _probe(*file_signature(path))
+
+
+@functools.lru_cache(maxsize=256)
+def _keyframe_times(path: str, size: int, mtime_ns: int, read_seconds: float = None) -> tuple:
+    interval = f'-read_intervals %+{read_seconds}' if read_seconds else ''
+    cmd = f"ffprobe -v error -select_streams v:0 {interval} -show_entries packet=pts_time,flags -of csv=p=0 {path}"
+    output = subprocess.run(cmd, shell=True, capture_output=True).stdout.decode()
+    times = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            times.append(float(pts_time))
+    return tuple(sorted(times))
+
+
+def keyframe_times(path: str, read_seconds: float = None) -> list:
+    '''Returns the times of the video keyframes, read from the packet flags without decoding anything'''
+    return list(_keyframe_times(*file_signature(path), read_seconds))
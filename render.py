@@ -1,34 +1,174 @@
-import math
-import subprocess
+import os
 import textwrap
 
+from cache import cache_key, file_hash
+from encoders import encoder_args
+from layout import Layout
+from pcm import voiceover_input
+from probe import probe
+from subtitles import FONTS_DIR, caption_chunks, subtitle_path, write_ass_subtitles
+from tracing import tracer
+
+DRAFT_WIDTH = 540
+DRAFT_HEIGHT = 960
+# the background is blurred at this fraction of the output size, 1.0 blurs the full frame
+BLUR_QUALITY = 0.25
+
 
 def extract_resolution(input_file: str) -> tuple[int]:
-    cmd = f"ffprobe -v error -select_streams v:0 -show_entries stream=width,height -of csv=s=x:p=0 {input_file}"
-    output = subprocess.run(cmd, shell=True, capture_output=True)
-    output = output.stdout.decode()
-    width, height = output.split('x')
-    return int(width), int(height)
+    return probe(input_file).size
+
+
+def extract_duration(input_file: str) -> float:
+    return probe(input_file).duration
+
+
+def scale_filter(input_size, width: int, height: int, flags: str = None) -> str:
+    '''Returns a scale to width x height, or nothing when the input is already that size'''
+    if input_size and tuple(int(v) for v in input_size) == (width, height):
+        return ''
+    return f'scale={width}:{height}' + (f':flags={flags}' if flags else '')
+
 
+def filter_chain(*filters: str) -> str:
+    # a chain whose steps were all skipped still needs a filter between its labels
+    return ','.join(f for f in filters if f) or 'null'
 
-def crop_video(input_file: str, output_file: str, x: int, y: int, w: int, h: int, width: int = 2160, height: int = 2160):
-    cmd = f"ffmpeg -y -i {input_file} -filter:v \"crop={w}:{h}:{x}:{y},scale={width}:{height}\" {output_file}"
-    subprocess.run(cmd, shell=True)
 
+def crop_video(input_file: str, output_file: str, x: int, y: int, w: int, h: int, width: int = 2160, height: int = 2160, codec_args: str = '', check: bool = False):
+    chain = filter_chain(f'crop={w}:{h}:{x}:{y}', scale_filter((w, h), width, height))
+    cmd = f"ffmpeg -y -i {input_file} -filter:v \"{chain}\" {codec_args} {output_file}"
+    tracer.run(cmd, 'crop_video', check=check)
 
-def scale_video(input_file: str, output_file: str, w: int, h: int):
-    cmd = f"ffmpeg -y -i {input_file} -vf scale={w}:{h} {output_file}"
-    subprocess.run(cmd, shell=True)
 
+def crop_video_path(input_file: str, output_file: str, w: int, h: int, path: list, width: int = 2160, height: int = 2160, codec_args: str = ''):
+    '''Crops a w x h window that moves along path, a list of (time, x, y), using sendcmd'''
+    commands_file = f'{output_file}.cmd'
+    with open(commands_file, 'w') as f:
+        for t, x, y in path:
+            f.write(f'{t:.3f} crop x {x}, crop y {y};\n')
+    _, x, y = path[0]
+    cmd = f"ffmpeg -y -i {input_file} -filter:v \"sendcmd=f={commands_file},crop={w}:{h}:{x}:{y},scale={width}:{height}\" {codec_args} {output_file}"
+    tracer.run(cmd, 'crop_video_path')
+    os.remove(commands_file)
 
-def blur_video(input_file: str, output_file: str, blur: int = 15):
+
+def scale_video(input_file: str, output_file: str, w: int, h: int, codec_args: str = ''):
+    cmd = f"ffmpeg -y -i {input_file} -vf scale={w}:{h} {codec_args} {output_file}"
+    tracer.run(cmd, 'scale_video')
+
+
+def blur_video(input_file: str, output_file: str, blur: int = 15, codec_args: str = ''):
     width, height = extract_resolution(input_file)
     h = height
     w = int(height * 9 / 16)
     x = (width - w) / 2
     y = 0
-    cmd = f"ffmpeg -y -i {input_file} -filter:v \"crop={w}:{h}:{x}:{y},boxblur={blur}:1\" {output_file}"
-    subprocess.run(cmd, shell=True)
+    cmd = f"ffmpeg -y -i {input_file} -filter:v \"crop={w}:{h}:{x}:{y},boxblur={blur}:1\" {codec_args} {output_file}"
+    tracer.run(cmd, 'blur_video')
+
+
+def background_crop(width: int, height: int) -> tuple[int]:
+    '''Returns the x, y, w, h of the center 9:16 portion of the video'''
+    h = height
+    w = int(height * 0.5625)  # 9/16 in decimal
+    x = (width - w) / 2
+    y = 0
+    return x, y, w, h
+
+
+def box_crop(width: int, height: int) -> tuple[int]:
+    '''Returns the x, y, w, h of the center 1:1 portion of the video'''
+    square_size = min(width, height)
+    x = (width - square_size) // 2
+    y = (height - square_size) // 2
+    return x, y, square_size, square_size
+
+
+def background_blur_filter(width: int, height: int, blur_strength: int, quality: float = BLUR_QUALITY, crop: tuple = None, input_size: tuple = None) -> str:
+    '''Returns the filter chain that turns the background into a blurred width x height frame.
+    Below quality 1.0 it blurs a downscaled copy with a proportionally smaller radius and scales the result up,
+    the output is already blurry so the lost detail doesn't show. A scale to the size the input already has is left out'''
+    filters = []
+    if crop:
+        x, y, w, h = crop
+        filters.append(f'crop={w}:{h}:{x}:{y}')
+        input_size = (w, h)
+    if quality >= 1:
+        filters += [scale_filter(input_size, width, height), f'boxblur={blur_strength}:1']
+    else:
+        work_width, work_height = Layout(width, height).blur_size(quality)
+        radius = max(1, round(blur_strength * quality))
+        filters += [
+            scale_filter(input_size, work_width, work_height, 'area'),
+            f'boxblur={radius}:1',
+            f'scale={width}:{height}:flags=bilinear',
+        ]
+    return filter_chain(*filters)
+
+
+def text_filters(last_label, overlay_text_top=None, overlay_text_bottom=None, captions=None, layout=None):
+    '''Builds the drawtext chain for the titles and captions, returns it with its output label'''
+    layout = layout or Layout()
+    filter_complex = ''
+
+    if overlay_text_top:
+        wrapped_lines = textwrap.wrap(overlay_text_top, width=25)
+        for i, line in enumerate(wrapped_lines):
+            safe_text = line.replace("'", r"\'") + "\u00A0\u00A0"
+            filter_complex += (
+                f'; [{last_label}]drawtext='
+                f"text='{safe_text} ':"
+                f"fontfile=fonts/Bangers-Regular.ttf:"
+                f"fontcolor=lightblue:fontsize={layout.font_size('top')}:x=(w-text_w)/2+{layout.x_offset('top')}:y={layout.line_y('top', i)}:"
+                f"borderw={layout.border}:bordercolor=black"
+                f"[t{i}]"
+            )
+            last_label = f't{i}'
+
+    if overlay_text_bottom:
+        wrapped_lines = textwrap.wrap(overlay_text_bottom, width=25)
+        for i, line in enumerate(wrapped_lines):
+            safe_text = line.replace("'", r"\'") + "\u00A0\u00A0"
+            filter_complex += (
+                f'; [{last_label}]drawtext='
+                f"text='{safe_text} ':"
+                f"fontfile=fonts/Bangers-Regular.ttf:"
+                f"fontcolor=white:fontsize={layout.font_size('bottom')}:x=(w-text_w)/2+{layout.x_offset('bottom')}:y={layout.line_y('bottom', i)}:"
+                f"borderw={layout.border}:bordercolor=black"
+                f"[b{i}]"
+            )
+            last_label = f'b{i}'
+
+    if captions:
+        for i, (chunk_start, chunk_end, chunk_text) in enumerate(caption_chunks(captions)):
+            chunk_text = chunk_text.replace("'", r"\'") + "\u00A0\u00A0"
+
+            filter_complex += (
+                f"; [{last_label}]drawtext="
+                f"text='{chunk_text}':"
+                f"enable='between(t,{chunk_start},{chunk_end})':"
+                f"fontfile=fonts/Bangers-Regular.ttf:"
+                f"fontcolor=white:fontsize={layout.font_size('caption')}:x=(w-text_w)/2+{layout.x_offset('caption')}:y={layout.line_y('caption')}:"
+                f"borderw={layout.border}:bordercolor=black"
+                f"[cap{i}]"
+            )
+            last_label = f'cap{i}'
+
+    return filter_complex, last_label
+
+
+def voiceover_mix_filter(clip_audio: str, voice_audio: str, output_label: str, delay: float = 8.0, clip_volume: float = 0.3) -> str:
+    '''Ducks the clip audio and lays the voiceover over it, starting `delay` seconds in.
+    Without clip_audio (a silent clip) the output is just the delayed voiceover'''
+    delay_ms = int(delay * 1000)
+    if not clip_audio:
+        return f'[{voice_audio}]adelay={delay_ms}|{delay_ms}[{output_label}]'
+    return (
+        f'[{clip_audio}]volume={clip_volume}[clipvol]; '
+        f'[{voice_audio}]adelay={delay_ms}|{delay_ms}[voicedelay]; '
+        f'[clipvol][voicedelay]amix=inputs=2:duration=first:dropout_transition=0:normalize=0[{output_label}]'
+    )
 
 
 def create_mobile_video(
@@ -40,8 +180,11 @@ def create_mobile_video(
     captions=None,
     blur_strength=15,
     fps=60,
-    voiceover_file=None
+    voiceover_file=None,
+    blur_quality=BLUR_QUALITY,
+    codec_args=None
 ):
+    codec_args = codec_args or encoder_args()
     _, content_height = extract_resolution(content_file)
     print(_, content_height)
     background_width, background_height = extract_resolution(background_file)
@@ -50,68 +193,17 @@ def create_mobile_video(
     content_y = int((background_height - content_height) / 2)
 
     input_args = f'-i {background_file} -i {content_file}'
-    filter_complex = f'[0:v] boxblur={blur_strength}:1 [a]; [a][1:v] overlay={content_x}:{content_y} [b]'
+    blur_filter = background_blur_filter(background_width, background_height, blur_strength, blur_quality)
+    filter_complex = f'[0:v] {blur_filter} [a]; [a][1:v] overlay={content_x}:{content_y} [b]'
     last_label = 'b'
     input_index = 2
 
-    if overlay_text_top:
-        wrapped_lines = textwrap.wrap(overlay_text_top, width=25)
-        for i, line in enumerate(wrapped_lines):
-            safe_text = line.replace("'", r"\'") + "\u00A0\u00A0"
-            y_pos = f"h-{3220 - i * 200}"
-            filter_complex += (
-                f'; [{last_label}]drawtext='
-                f"text='{safe_text} ':" 
-                f"fontfile=Bangers-Regular.ttf:"
-                f"fontcolor=lightblue:fontsize=230:x=(w-text_w)/2+12:y={y_pos}+20:"
-                f"borderw=15:bordercolor=black"
-                f"[t{i}]"\
-            )
-            last_label = f't{i}'
-
-    if overlay_text_bottom:
-        wrapped_lines = textwrap.wrap(overlay_text_bottom, width=25)
-        for i, line in enumerate(wrapped_lines):
-            safe_text = line.replace("'", r"\'") + "\u00A0\u00A0"
-            y_pos = f"h-{3000 - i * 200}"
-            filter_complex += (
-                f'; [{last_label}]drawtext='
-                f"text='{safe_text} ':" 
-                f"fontfile=Bangers-Regular.ttf:"
-                f"fontcolor=white:fontsize=160:x=(w-text_w)/2+10:y={y_pos}+20:"
-                f"borderw=15:bordercolor=black"
-                f"[t{i}]"
-            )
-            last_label = f't{i}'
-
-    if captions:
-        for i, (start, end, text) in enumerate(captions):
-            words = text.split()
-            chunk_size = 3
-            num_chunks = math.ceil(len(words) / chunk_size)
-            duration = end - start
-            chunk_duration = duration / num_chunks
-
-            for j in range(num_chunks):
-                chunk_start = start + j * chunk_duration
-                chunk_end = chunk_start + chunk_duration
-                chunk_words = words[j * chunk_size: (j + 1) * chunk_size]
-                chunk_text = " ".join(chunk_words).replace("'", r"\'") + "\u00A0\u00A0"
-                y_pos = "h-930"
-
-                filter_complex += (
-                    f"; [{last_label}]drawtext="
-                    f"text='{chunk_text}':"
-                    f"enable='between(t,{chunk_start},{chunk_end})':"
-                    f"fontfile=Bangers-Regular.ttf:"
-                    f"fontcolor=white:fontsize=180:x=(w-text_w)/2+12:y={y_pos}:"
-                    f"borderw=15:bordercolor=black"
-                    f"[cap{i}_{j}]"
-                )
-                last_label = f'cap{i}_{j}'
+    text_filter, last_label = text_filters(last_label, overlay_text_top, overlay_text_bottom, captions, Layout(background_width, background_height))
+    filter_complex += text_filter
 
+    voice_args, voice_data = voiceover_input(voiceover_file)
     if voiceover_file:
-        input_args += f' -i {voiceover_file}'
+        input_args += f' {voice_args}'
         filter_complex += (
             f'; [{input_index}:a]volume=3.0[vo]; '
             f'[0:a][vo] amerge=inputs=2[aout]'
@@ -122,9 +214,189 @@ def create_mobile_video(
 
     cmd = (
         f'ffmpeg -y -r {fps} {input_args} -filter_complex "{filter_complex}" '
-        f'{audio_map} -r {fps} '
-        f'-c:v h264_nvenc -preset p7 -rc vbr -cq 19 -b:v 0 '
-        f'-c:a aac -b:a 192k -pix_fmt yuv420p {output_file}'
+        f'{audio_map} -r {fps} {codec_args} {output_file}'
+    )
+
+    tracer.run(cmd, 'create_mobile_video', input=voice_data)
+
+
+def composite_filtergraph(
+    input_file,
+    source_width,
+    source_height,
+    width=2160,
+    height=3840,
+    box_size=None,
+    overlay_text_top=None,
+    overlay_text_bottom=None,
+    captions=None,
+    blur_strength=20,
+    voiceover_file=None,
+    delay=8.0,
+    layers=None,
+    subtitle_file=None,
+    blur_quality=BLUR_QUALITY,
+    input_options=''
+):
+    '''Returns the input args, filter_complex, video output label and audio of the composition. The audio is the
+    mixed voiceover's label, the clip's audio stream, or None for a silent clip without voiceover. layers can be an already cropped (background, box) pair, in which case the crop stage is skipped.
+    With a subtitle_file the titles and captions are drawn from it, otherwise as a drawtext chain.
+    blur_strength is the radius at 2160x3840, it is scaled with the rest of the layout, and blur_quality sets the
+    fraction of the output size the background is blurred at. input_options go in front of every video input, e.g. a seek'''
+    layout = Layout(width, height)
+    box_size = box_size or layout.box_size
+    blur_strength = layout.blur(blur_strength)
+    content_x = 0
+    content_y = int((height - box_size) / 2)
+
+    if layers:
+        background_file, box_file = layers
+        input_args = f'{input_options} -i {background_file} {input_options} -i {box_file}'
+        blur_filter = background_blur_filter(width, height, blur_strength, blur_quality, input_size=extract_resolution(background_file))
+        filter_complex = f'[0:v] {blur_filter} [a]; [a][1:v] overlay={content_x}:{content_y} [b]'
+    else:
+        bg_x, bg_y, bg_w, bg_h = background_crop(source_width, source_height)
+        box_x, box_y, box_w, box_h = box_crop(source_width, source_height)
+        input_args = f'{input_options} -i {input_file}'
+        filter_complex = (
+            f'[0:v] split=2 [src0][src1]; '
+            f'[src0] {background_blur_filter(width, height, blur_strength, blur_quality, (bg_x, bg_y, bg_w, bg_h))} [a]; '
+            f'[src1] {filter_chain(f"crop={box_w}:{box_h}:{box_x}:{box_y}", scale_filter((box_w, box_h), box_size, box_size))} [box]; '
+            f'[a][box] overlay={content_x}:{content_y} [b]'
+        )
+    last_label = 'b'
+    voice_index = 2 if layers else 1
+    # the background layer carries the clip's audio when the crops come from the cache
+    clip_audio = '0:a' if probe(layers[0] if layers else input_file).has_audio else None
+
+    if subtitle_file:
+        # one libass layer, however many captions there are
+        filter_complex += f'; [{last_label}] ass={subtitle_file}:fontsdir={FONTS_DIR} [subs]'
+        last_label = 'subs'
+    else:
+        text_filter, last_label = text_filters(last_label, overlay_text_top, overlay_text_bottom, captions, layout)
+        filter_complex += text_filter
+
+    if voiceover_file:
+        # a PcmAudio voiceover is read from stdin, whoever runs the command pipes it in
+        input_args += f' {voiceover_input(voiceover_file)[0]}'
+        filter_complex += '; ' + voiceover_mix_filter(clip_audio, f'{voice_index}:a', 'aout', delay=delay)
+        return input_args, filter_complex, last_label, 'aout'
+    return input_args, filter_complex, last_label, clip_audio
+
+
+def audio_map_args(audio=None) -> str:
+    '''Maps a filter label or an input stream like 0:a, or drops audio when there is none'''
+    if not audio:
+        return '-an'
+    if ':' in audio:
+        return f'-map {audio}'
+    return f'-map "[{audio}]"'
+
+
+def render_filtergraph(input_file, source_width, source_height, **kwargs):
+    '''Returns the input args, filter_complex and stream maps of the composition, see composite_filtergraph'''
+    input_args, filter_complex, video_label, audio = composite_filtergraph(input_file, source_width, source_height, **kwargs)
+    return input_args, filter_complex, f'-map "[{video_label}]" {audio_map_args(audio)}'
+
+
+def build_render_plan(input_file, output_file, source_width, source_height, fps=60, codec_args=None, **kwargs):
+    '''Builds one ffmpeg command that crops, blurs, overlays, draws text and mixes audio in a single pass over the source'''
+    codec_args = codec_args or encoder_args()
+    input_args, filter_complex, audio_map = render_filtergraph(input_file, source_width, source_height, **kwargs)
+    return (
+        f'ffmpeg -y {input_args} -filter_complex "{filter_complex}" '
+        f'{audio_map} -r {fps} {codec_args} {output_file}'
     )
 
-    subprocess.run(cmd, shell=True)
+
+def composite_size(variants) -> tuple[int]:
+    '''Returns the largest variant's size, the others are scaled down from it'''
+    return max(((w, h) for _, w, h, _ in variants), key=lambda size: size[0] * size[1])
+
+
+def build_variant_plan(input_file, variants, source_width, source_height, fps=60, **kwargs):
+    '''Builds one ffmpeg command that composites once at the largest variant's size and writes every
+    (output_file, width, height, codec_args) variant from a split of that stream'''
+    width, height = composite_size(variants)
+    input_args, filter_complex, video_label, audio = composite_filtergraph(
+        input_file, source_width, source_height, width=width, height=height, **kwargs
+    )
+    count = len(variants)
+    filter_complex += f'; [{video_label}] split={count} ' + ''.join(f'[split{i}]' for i in range(count))
+    # a filter output can only be mapped once, an input stream any number of times
+    split_audio = audio and ':' not in audio and count > 1
+    if split_audio:
+        filter_complex += f'; [{audio}] asplit={count} ' + ''.join(f'[asplit{i}]' for i in range(count))
+    outputs = []
+    for i, (output_file, w, h, codec_args) in enumerate(variants):
+        filter_complex += f'; [split{i}] {filter_chain(scale_filter((width, height), w, h))} [out{i}]'
+        audio_map = audio_map_args(f'asplit{i}' if split_audio else audio)
+        outputs.append(f'-map "[out{i}]" {audio_map} -r {fps} {codec_args} {output_file}')
+    return f'ffmpeg -y {input_args} -filter_complex "{filter_complex}" ' + ' '.join(outputs)
+
+
+def render_mobile_video(input_file, output_file, text_renderer='ass', **kwargs):
+    '''Renders the finished vertical video straight from the source (or cached crop layers), without intermediate files.
+    text_renderer picks between a single ASS subtitle layer and the older per-line drawtext chain'''
+    source_width, source_height = extract_resolution(input_file)
+    subtitle_file = None
+    if text_renderer == 'ass':
+        subtitle_file = write_ass_subtitles(
+            subtitle_path(),
+            kwargs.get('width', 2160),
+            kwargs.get('height', 3840),
+            kwargs.get('overlay_text_top'),
+            kwargs.get('overlay_text_bottom'),
+            kwargs.get('captions'),
+        )
+    try:
+        cmd = build_render_plan(input_file, output_file, source_width, source_height, subtitle_file=subtitle_file, **kwargs)
+        _, voice_data = voiceover_input(kwargs.get('voiceover_file'))
+        tracer.run(cmd, 'render_mobile_video', check=True, input=voice_data)
+    finally:
+        if subtitle_file:
+            os.remove(subtitle_file)
+
+
+def render_variants(input_file, variants, text_renderer='ass', **kwargs):
+    '''Renders every (output_file, width, height, codec_args) variant from one decode and composite of the source.
+    kwargs are render_mobile_video's apart from the output size and codec'''
+    source_width, source_height = extract_resolution(input_file)
+    subtitle_file = None
+    if text_renderer == 'ass':
+        subtitle_file = write_ass_subtitles(
+            subtitle_path(),
+            *composite_size(variants),
+            kwargs.get('overlay_text_top'),
+            kwargs.get('overlay_text_bottom'),
+            kwargs.get('captions'),
+        )
+    try:
+        cmd = build_variant_plan(input_file, variants, source_width, source_height, subtitle_file=subtitle_file, **kwargs)
+        _, voice_data = voiceover_input(kwargs.get('voiceover_file'))
+        tracer.run(cmd, 'render_variants', check=True, input=voice_data)
+    finally:
+        if subtitle_file:
+            os.remove(subtitle_file)
+
+
+def cached_crop_layers(input_file, cache, width=2160, height=3840, box_size=None, blur_quality=BLUR_QUALITY):
+    '''Returns the (background, box) crops of input_file from cache, rendering whichever is missing.
+    The background is only ever shown blurred, so it is stored at the blur's working size'''
+    source_hash = file_hash(input_file)
+    source_width, source_height = extract_resolution(input_file)
+    layout = Layout(width, height)
+    box_size = box_size or layout.box_size
+    background_size = layout.blur_size(blur_quality) if blur_quality < 1 else (width, height)
+    # the crops get encoded again, so they are kept at a higher quality than the ffmpeg default
+    codec_args = encoder_args('intermediate')
+    layers = []
+    for name, crop, size in (
+        ('background', background_crop(source_width, source_height), background_size),
+        ('box', box_crop(source_width, source_height), (box_size, box_size)),
+    ):
+        key = cache_key(source_hash, name, crop, size, codec_args)
+        # a crop that dies mid-encode leaves a truncated file, which must not be moved into the cache
+        layers.append(cache.fetch(key, lambda path: crop_video(input_file, path, *crop, *size, codec_args=codec_args, check=True)))
+    return tuple(layers)
@@ -0,0 +1,141 @@
+import os
+import re
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from encoders import AUDIO_ARGS, encoder_args
+from pcm import voiceover_input
+from probe import keyframe_times, probe
+from render import build_render_plan, voiceover_mix_filter
+from subtitles import subtitle_path, write_ass_subtitles
+from tracing import tracer
+
+
+def segment_bounds(keyframes: list, duration: float, count: int, fps: int) -> list:
+    '''Splits the clip into up to count (start, end) segments cut at the keyframes nearest to even splits.
+    Cuts are snapped to the output frame grid so no frame is rendered twice or skipped'''
+    cuts = []
+    for i in range(1, count):
+        if not keyframes:
+            break
+        target = duration * i / count
+        cut = round(min(keyframes, key=lambda t: abs(t - target)) * fps) / fps
+        if 0 < cut < duration and (not cuts or cut > cuts[-1]):
+            cuts.append(cut)
+    bounds = [0.0] + cuts + [duration]
+    return list(zip(bounds, bounds[1:]))
+
+
+def shift_captions(captions, start: float, end: float) -> list:
+    '''Returns the captions that overlap [start, end) with their times relative to start'''
+    return [(s - start, e - start, text) for s, e, text in captions or () if e > start and s < end]
+
+
+def null_stats(cmd: str) -> tuple:
+    '''Runs an ffmpeg command into the null muxer and returns the (frames, seconds) of its last progress line'''
+    output = subprocess.run(f'{cmd} -f null -', shell=True, capture_output=True).stderr.decode(errors='replace')
+    frames = re.findall(r'frame=\s*(\d+)', output)
+    times = re.findall(r'time=\s*(\d+):(\d+):([\d.]+)', output)
+    if not frames or not times:
+        raise RuntimeError(f'Could not read ffmpeg progress from: {cmd}')
+    h, m, s = times[-1]
+    return int(frames[-1]), int(h) * 3600 + int(m) * 60 + float(s)
+
+
+def render_audio(input_file: str, output_file: str, voiceover_file=None, delay: float = 8.0) -> bool:
+    '''Renders the whole soundtrack in one pass, so the joined video has no seams in the audio.
+    Returns False when there is no audio to render'''
+    has_audio = probe(input_file).has_audio
+    if not has_audio and not voiceover_file:
+        return False
+    voice_args, voice_data = voiceover_input(voiceover_file)
+    if voiceover_file:
+        mix = voiceover_mix_filter('0:a' if has_audio else None, '1:a', 'aout', delay=delay)
+        cmd = f'ffmpeg -y -v error -i {input_file} {voice_args} -filter_complex "{mix}" -map "[aout]" {AUDIO_ARGS} {output_file}'
+    else:
+        cmd = f'ffmpeg -y -v error -i {input_file} -map 0:a -vn {AUDIO_ARGS} {output_file}'
+    tracer.run(cmd, 'render_audio', check=True, input=voice_data)
+    return True
+
+
+def render_segmented(input_file, output_file, segments=4, text_renderer='ass', workers=None, verify=False, **kwargs):
+    '''Renders like render.render_mobile_video, but as parallel ffmpeg processes over keyframe-aligned segments
+    whose video is joined with the concat demuxer without re-encoding. kwargs are render_mobile_video's'''
+    source = probe(input_file)
+    source_width, source_height = source.size
+    duration = source.duration
+    fps = kwargs.pop('fps', 60)
+    codec_args = kwargs.pop('codec_args', None) or encoder_args()
+    voiceover_file = kwargs.pop('voiceover_file', None)
+    delay = kwargs.pop('delay', 8.0)
+    captions = kwargs.pop('captions', None)
+    bounds = segment_bounds(keyframe_times(input_file), duration, segments, fps)
+
+    workdir = f'{output_file}.segments'
+    os.makedirs(workdir, exist_ok=True)
+    subtitle_files = []
+    try:
+        commands = []
+        for i, (start, end) in enumerate(bounds):
+            segment_captions = shift_captions(captions, start, end)
+            segment_kwargs = dict(kwargs, captions=segment_captions)
+            if text_renderer == 'ass':
+                # the scripts' paths go into the filtergraphs, so they don't live under the output's name
+                segment_kwargs['subtitle_file'] = write_ass_subtitles(
+                    subtitle_path(),
+                    kwargs.get('width', 2160),
+                    kwargs.get('height', 3840),
+                    kwargs.get('overlay_text_top'),
+                    kwargs.get('overlay_text_bottom'),
+                    segment_captions,
+                )
+                subtitle_files.append(segment_kwargs['subtitle_file'])
+            # the last segment runs to the end of the source like a single render would
+            frames = f'-frames:v {round(end * fps) - round(start * fps)}' if i < len(bounds) - 1 else ''
+            commands.append(build_render_plan(
+                input_file, os.path.join(workdir, f'{i}.mp4'), source_width, source_height, fps=fps,
+                codec_args=f'{codec_args} -an {frames}', input_options=f'-ss {start:.6f}', **segment_kwargs,
+            ))
+
+        audio_file = os.path.join(workdir, 'audio.m4a')
+        # pool threads don't share this thread's job context
+        job = tracer.job()
+        with ThreadPoolExecutor(max_workers=workers or len(commands) + 1) as pool:
+            has_audio = pool.submit(tracer.call, 'audio', job, render_audio, input_file, audio_file, voiceover_file, delay)
+            for result in pool.map(lambda i: tracer.call(f'segment {i}', job, tracer.run, commands[i], 'render_segment'), range(len(commands))):
+                if result.returncode != 0:
+                    raise RuntimeError(f'Segment render failed: {result.args}')
+            has_audio = has_audio.result()
+
+        list_file = os.path.join(workdir, 'segments.txt')
+        with open(list_file, 'w') as f:
+            # concat resolves relative paths against the list file
+            f.writelines(f"file '{i}.mp4'\n" for i in range(len(commands)))
+        audio_args = f'-i {audio_file} -map 0:v -map 1:a' if has_audio else '-map 0:v'
+        tracer.run(f'ffmpeg -y -v error -f concat -safe 0 -i {list_file} {audio_args} -c copy -movflags +faststart {output_file}', 'concat', check=True)
+    finally:
+        # the pieces are only scratch, a failed render leaves nothing behind to mistake for output
+        for subtitle_file in subtitle_files:
+            os.remove(subtitle_file)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if verify:
+        verify_segmented_render(input_file, output_file, source_width, source_height, fps, **kwargs)
+    return output_file
+
+
+def verify_segmented_render(input_file, output_file, source_width, source_height, fps=60, **kwargs):
+    '''Checks that the joined video has the frame count and duration of a single-process render of the same graph.
+    Text doesn't change the frame count, so the reference leaves it out'''
+    kwargs = {key: value for key, value in kwargs.items() if key not in ('overlay_text_top', 'overlay_text_bottom', 'subtitle_file')}
+    reference = build_render_plan(input_file, '', source_width, source_height, fps=fps, codec_args='-an', **kwargs)
+    expected_frames, expected_seconds = null_stats(reference)
+    # decoded like the reference, ffmpeg doesn't report frames for stream copies
+    frames, seconds = null_stats(f'ffmpeg -y -i {output_file} -map 0:v')
+    if frames != expected_frames or abs(seconds - expected_seconds) > 1 / fps:
+        raise RuntimeError(
+            f'{output_file} has {frames} frames over {seconds:.3f}s, '
+            f'a single-process render has {expected_frames} frames over {expected_seconds:.3f}s'
+        )
+    print(f"Verified {output_file}: {frames} frames over {seconds:.3f}s")
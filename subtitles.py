@@ -0,0 +1,112 @@
+import math
+import os
+import tempfile
+import textwrap
+
+from layout import Layout
+
+FONT_NAME = 'Bangers'
+# libass loads every file in here, so it only holds Bangers-Regular.ttf
+FONTS_DIR = 'fonts'
+
+
+def subtitle_path() -> str:
+    '''Returns a new file for an ASS script in the working directory. Its path goes into the filtergraph unescaped,
+    so it is a bare name: no commas, brackets or semicolons from the output name, and no drive colon or backslashes
+    from an absolute Windows path'''
+    fd, path = tempfile.mkstemp(prefix='subs_', suffix='.ass', dir='.')
+    os.close(fd)
+    return os.path.relpath(path)
+
+
+def caption_chunks(captions, chunk_size=3):
+    '''Splits each (start, end, text) caption into chunk_size word pieces that share its time evenly'''
+    for start, end, text in captions:
+        words = text.split()
+        num_chunks = math.ceil(len(words) / chunk_size)
+        if not num_chunks:
+            continue
+        duration = end - start
+        chunk_duration = duration / num_chunks
+
+        for j in range(num_chunks):
+            chunk_start = start + j * chunk_duration
+            chunk_end = chunk_start + chunk_duration
+            chunk_words = words[j * chunk_size: (j + 1) * chunk_size]
+            yield chunk_start, chunk_end, " ".join(chunk_words)
+
+
+def ass_colour(red: int, green: int, blue: int) -> str:
+    # ASS colours are &HAABBGGRR with 00 alpha meaning opaque
+    return f'&H00{blue:02X}{green:02X}{red:02X}'
+
+
+def ass_time(seconds: float) -> str:
+    centiseconds = max(0, round(seconds * 100))
+    h, centiseconds = divmod(centiseconds, 360000)
+    m, centiseconds = divmod(centiseconds, 6000)
+    s, cs = divmod(centiseconds, 100)
+    return f'{h}:{m:02}:{s:02}.{cs:02}'
+
+
+def ass_text(text: str) -> str:
+    # braces open override blocks and a backslash starts a tag, neither can appear literally
+    return text.replace('\\', '/').replace('{', '(').replace('}', ')')
+
+
+def write_ass_subtitles(path: str, width: int, height: int, overlay_text_top=None, overlay_text_bottom=None, captions=None):
+    '''Writes the titles and captions as one ASS script, laid out like the drawtext chain in render.text_filters'''
+    layout = Layout(width, height)
+    white = ass_colour(255, 255, 255)
+    black = ass_colour(0, 0, 0)
+    styles = [
+        # name, layout style, colour
+        ('Top', 'top', ass_colour(173, 216, 230)),  # lightblue
+        ('Bottom', 'bottom', white),
+        ('Caption', 'caption', white),
+    ]
+    lines = [
+        '[Script Info]',
+        'ScriptType: v4.00+',
+        f'PlayResX: {width}',
+        f'PlayResY: {height}',
+        'WrapStyle: 2',
+        'ScaledBorderAndShadow: yes',
+        '',
+        '[V4+ Styles]',
+        'Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, '
+        'Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding',
+    ]
+    for name, style, colour in styles:
+        # alignment 8 is top center, positions below are the top edge of the text like drawtext's y
+        lines.append(
+            f'Style: {name},{FONT_NAME},{layout.font_size(style)},{colour},{colour},{black},{black},'
+            f'0,0,0,0,100,100,0,0,1,{layout.border},0,8,0,0,0,1'
+        )
+    lines += [
+        '',
+        '[Events]',
+        'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text',
+    ]
+
+    def dialogue(layer, start, end, name, style, line, text):
+        x = width / 2 + layout.x_offset(style)
+        y = layout.line_y(style, line)
+        return f'Dialogue: {layer},{start},{end},{name},,0,0,0,,{{\\pos({x:.0f},{y})}}{ass_text(text)}'
+
+    forever = ass_time(10 * 3600 - 1)
+    if overlay_text_top:
+        for i, line in enumerate(textwrap.wrap(overlay_text_top, width=25)):
+            lines.append(dialogue(0, ass_time(0), forever, 'Top', 'top', i, line))
+
+    if overlay_text_bottom:
+        for i, line in enumerate(textwrap.wrap(overlay_text_bottom, width=25)):
+            lines.append(dialogue(0, ass_time(0), forever, 'Bottom', 'bottom', i, line))
+
+    if captions:
+        for start, end, text in caption_chunks(captions):
+            lines.append(dialogue(1, ass_time(start), ass_time(end), 'Caption', 'caption', 0, text))
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
@@ -0,0 +1,43 @@
+import unittest
+
+from yt_dlp import YoutubeDL
+
+from dl import DEFAULT_FORMAT, plan_format, use_planned_format
+
+
+def video_format(format_id, height, acodec='mp4a.40.2', filesize=None):
+    return {
+        'format_id': format_id, 'url': f'https://example.com/{format_id}.mp4', 'ext': 'mp4', 'protocol': 'https',
+        'height': height, 'width': height * 16 // 9, 'vcodec': 'avc1', 'acodec': acodec, 'filesize': filesize,
+    }
+
+
+def info_dict(*formats):
+    return {'id': 'clip', 'title': 'clip', 'extractor': 'test', 'extractor_key': 'Test', 'webpage_url': 'https://example.com/clip', 'formats': list(formats)}
+
+
+class PlanFormatTest(unittest.TestCase):
+    def test_smallest_adequate(self):
+        formats = [video_format('360', 360), video_format('720', 720), video_format('1080', 1080)]
+        self.assertEqual(plan_format(formats, 480), '720')
+
+    def test_tallest_when_none_adequate(self):
+        self.assertEqual(plan_format([video_format('360', 360), video_format('720', 720)], 2160), '720')
+
+    def test_video_only_gets_audio(self):
+        self.assertEqual(plan_format([video_format('1080', 1080, acodec='none')], 720), '1080+bestaudio/1080')
+
+    def test_no_heights(self):
+        self.assertEqual(plan_format([{'format_id': 'x', 'vcodec': 'avc1'}], 720), DEFAULT_FORMAT)
+
+
+class UsePlannedFormatTest(unittest.TestCase):
+    def test_selection_follows_the_plan(self):
+        info = info_dict(video_format('360', 360, filesize=10), video_format('720', 720, filesize=20), video_format('1080', 1080, filesize=40))
+        with YoutubeDL({'quiet': True, 'format': DEFAULT_FORMAT}) as ydl:
+            self.assertEqual(use_planned_format(ydl, info, 360), '360')
+            self.assertEqual(ydl.process_ie_result(info, download=False)['format_id'], '360')
+
+
+if __name__ == '__main__':
+    unittest.main()
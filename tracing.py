@@ -0,0 +1,219 @@
+import contextlib
+import functools
+import json
+import os
+import subprocess
+import threading
+import time
+from collections import deque
+
+# ffmpeg's stderr is kept to show why a traced command failed
+STDERR_TAIL_LINES = 20
+
+
+def now_us() -> int:
+    # wall clock rather than a monotonic one, so spans from worker processes line up with the parent's
+    return time.time_ns() // 1000
+
+
+def rusage(children: bool = False):
+    '''Returns the resource usage of this process or its reaped children, or None where there is no resource module (Windows)'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+
+
+def parse_speed(value: str) -> float:
+    # ffmpeg reports speed like 1.52x, or N/A before the first frame
+    try:
+        return float(value.rstrip('x'))
+    except ValueError:
+        return None
+
+
+class Tracer:
+    '''Records spans, ffmpeg progress and resource usage as Chrome trace events (chrome://tracing, ui.perfetto.dev).
+    Disabled, which is the default, it only runs the commands and records nothing'''
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._named_threads = set()
+
+    def enable(self):
+        self.enabled = True
+        self.events = []
+
+    def job(self) -> int:
+        return getattr(self._local, 'job', 0)
+
+    @contextlib.contextmanager
+    def job_context(self, index: int):
+        '''Attributes the events of this thread to job index, each job is its own process lane in the trace'''
+        previous = self.job()
+        self._local.job = index
+        try:
+            yield
+        finally:
+            self._local.job = previous
+
+    def _add(self, **event):
+        tid = threading.get_native_id()
+        event = dict(pid=self.job(), tid=tid, **event)
+        with self._lock:
+            if (event['pid'], tid) not in self._named_threads:
+                self._named_threads.add((event['pid'], tid))
+                name = f'{threading.current_thread().name} (pid {os.getpid()})'
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': event['pid'], 'tid': tid, 'args': {'name': name}})
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args):
+        '''Times the block as one complete event. The yielded dict ends up in the event's args, so the block can add to it'''
+        if not self.enabled:
+            yield args
+            return
+        start = now_us()
+        thread_cpu = time.thread_time()
+        children = rusage(children=True)
+        try:
+            yield args
+        finally:
+            args.setdefault('wall_s', round((now_us() - start) / 1e6, 3))
+            args['thread_cpu_s'] = round(time.thread_time() - thread_cpu, 3)
+            if children:
+                after = rusage(children=True)
+                # children reaped during the span, which can include other threads' children when stages overlap
+                args.setdefault('children_cpu_s', round(after.ru_utime + after.ru_stime - children.ru_utime - children.ru_stime, 3))
+                args['process_peak_rss_mb'] = round(rusage().ru_maxrss / 1024, 1)
+            self._add(name=name, ph='X', ts=start, dur=now_us() - start, args=args)
+
+    def counter(self, name: str, **values):
+        if self.enabled:
+            self._add(name=name, ph='C', ts=now_us(), args=values)
+
+    def run(self, cmd: str, name: str, check: bool = False, input: bytes = None) -> subprocess.CompletedProcess:
+        '''Runs a shell command like subprocess.run(cmd, shell=True), piping input to its stdin when given.
+        Traced, an ffmpeg command reports its fps and speed through -progress and the span gets the
+        command's CPU time, peak RSS and disk I/O from wait4'''
+        if not self.enabled:
+            return subprocess.run(cmd, shell=True, check=check, input=input)
+        is_ffmpeg = cmd.startswith('ffmpeg ')
+        if is_ffmpeg:
+            cmd = cmd.replace('ffmpeg ', 'ffmpeg -progress pipe:1 -nostats ', 1)
+        with self.span(name, cmd=cmd) as args:
+            start = time.perf_counter()
+            process = subprocess.Popen(
+                cmd, shell=True, stdin=subprocess.PIPE if input is not None else None,
+                stdout=subprocess.PIPE if is_ffmpeg else None, stderr=subprocess.PIPE, text=True, errors='replace',
+            )
+            if input is not None:
+                # written from its own thread, ffmpeg only reads the pipe as fast as it encodes
+                threading.Thread(target=self._feed, args=(process.stdin.buffer, input), daemon=True).start()
+            tail = deque(maxlen=STDERR_TAIL_LINES)
+            drain = threading.Thread(target=lambda: tail.extend(process.stderr), daemon=True)
+            drain.start()
+            if is_ffmpeg:
+                self._read_progress(process.stdout, name, args)
+            if hasattr(os, 'wait4'):
+                # wait4 rather than wait, it returns the rusage of the shell and everything it waited for
+                _, status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+            else:
+                usage = None
+                process.wait()
+            drain.join()
+            args['returncode'] = process.returncode
+            if usage:
+                args.update(
+                    children_cpu_s=round(usage.ru_utime + usage.ru_stime, 3),
+                    peak_rss_mb=round(usage.ru_maxrss / 1024, 1),
+                    disk_read_bytes=usage.ru_inblock * 512,
+                    disk_write_bytes=usage.ru_oublock * 512,
+                )
+            if 'frames' in args:
+                # ffmpeg's own fps is a moving figure and reads 0 on short encodes
+                args['average_fps'] = round(args['frames'] / (time.perf_counter() - start), 1)
+            if process.returncode != 0:
+                args['stderr'] = ''.join(tail)
+                print(''.join(tail), end='')
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+        return subprocess.CompletedProcess(cmd, process.returncode)
+
+    @staticmethod
+    def _feed(stream, data: bytes):
+        try:
+            stream.write(data)
+            stream.close()
+        except BrokenPipeError:
+            # ffmpeg stopped reading, its exit code tells why
+            pass
+
+    def _read_progress(self, stream, name: str, args: dict):
+        block = {}
+        for line in stream:
+            key, _, value = line.strip().partition('=')
+            block[key] = value
+            if key != 'progress':
+                continue
+            fps = float(block.get('fps') or 0)
+            speed = parse_speed(block.get('speed', 'N/A'))
+            self.counter(f'{name} encode', fps=fps, speed=speed or 0)
+            args.update(frames=int(block.get('frame') or 0), fps=fps, speed=speed)
+            if block.get('total_size', 'N/A').isdigit():
+                args['output_bytes'] = int(block['total_size'])
+            block = {}
+
+    def call(self, name: str, job: int, func, /, *args, **kwargs):
+        '''Runs func in a span attributed to job, for pool threads that don't share the caller's job context'''
+        with self.job_context(job), self.span(name):
+            return func(*args, **kwargs)
+
+    def merge(self, events: list):
+        with self._lock:
+            self.events.extend(events)
+
+    def drain(self) -> list:
+        with self._lock:
+            events, self.events = self.events, []
+            self._named_threads = set()
+        return events
+
+    def write(self, path: str, job: int = None):
+        '''Writes the trace as Chrome trace JSON, only job's events when one is given'''
+        with self._lock:
+            events = [e for e in self.events if job is None or e['pid'] == job]
+        jobs = sorted({e['pid'] for e in events})
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': j, 'args': {'name': f'job {j}'}} for j in jobs] + events
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        print(f"Trace written to {path}")
+
+
+tracer = Tracer()
+
+
+def traced(name: str = None):
+    '''Decorates a function so each call is a span when tracing is on'''
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def call_traced(name: str, job: int, func, /, *args, **kwargs):
+    '''Tracer.call for a worker process: turns tracing on there and returns (result, events) for the parent to merge'''
+    if not tracer.enabled:
+        tracer.enable()
+    result = tracer.call(name, job, func, *args, **kwargs)
+    return result, tracer.drain()
@@ -1,26 +1,56 @@
+import json
 import os
 import re
-import requests # type: ignore
-import whisper # type: ignore
-from gtts import gTTS  # type: ignore
-from TTS.api import TTS as CoquiTTS  # type: ignore
-from moviepy.editor import VideoFileClip, AudioFileClip, CompositeAudioClip  # type: ignore
-from pydub import AudioSegment  # type: ignore
+
+from cache import cache_key, temp_path
+from models import registry
+from pcm import PcmAudio, apply_gain, decode_audio, from_int16, resample, voiceover_input
+from probe import probe
+from render import voiceover_mix_filter
+from tracing import traced, tracer
 
 TTS_PROVIDER = os.getenv("TTS_PROVIDER", "coqui").lower()  # Options: 'elevenlabs', 'gtts', or 'coqui'
 ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 ELEVENLABS_VOICE_ID = os.getenv("ELEVENLABS_VOICE_ID", "IRHApOXLvnW57QJPQH2P")
+COQUI_MODEL = "tts_models/en/vctk/vits"
+COQUI_SPEAKER = os.getenv("COQUI_SPEAKER", "p226")  # British male voice from VCTK
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "base")
+ELEVENLABS_SAMPLE_RATE = 24000
+WHISPER_SAMPLE_RATE = 16000  # whisper.audio.SAMPLE_RATE, the rate transcribe() expects arrays at
+
+
+# torch, Coqui and Whisper take seconds to import, so they load with the model instead of with this module
+def load_coqui():
+    from TTS.api import TTS as CoquiTTS  # type: ignore
+    return CoquiTTS(model_name=COQUI_MODEL)
+
+
+def load_whisper():
+    import whisper  # type: ignore
+    return whisper.load_model(WHISPER_MODEL)
+
 
+registry.register("coqui", load_coqui)
+registry.register("whisper", load_whisper)
 
-def generate_voiceover(text: str, output_path: str = "voice.mp3") -> str:
-    """Generates a voiceover using the selected TTS provider."""
+
+def preload_models():
+    """Starts loading the models a narration needs in the background, see ModelRegistry.preload."""
+    names = ["coqui", "whisper"] if TTS_PROVIDER == "coqui" else ["whisper"]
+    return registry.preload(*names)
+
+
+@traced()
+def generate_voiceover(text: str) -> PcmAudio:
+    """Generates a voiceover using the selected TTS provider, as PCM samples in memory."""
     if not text:
         raise ValueError("No text provided for TTS.")
 
     if TTS_PROVIDER == "elevenlabs":
         if not ELEVENLABS_API_KEY:
             raise EnvironmentError("ELEVENLABS_API_KEY is not set.")
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVENLABS_VOICE_ID}"
+        # raw PCM rather than the default mp3, so there is nothing to decode
+        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVENLABS_VOICE_ID}?output_format=pcm_{ELEVENLABS_SAMPLE_RATE}"
         headers = {
             "xi-api-key": ELEVENLABS_API_KEY,
             "Content-Type": "application/json"
@@ -33,56 +63,46 @@ def generate_voiceover(text: str, output_path: str = "voice.mp3") -> str:
             }
         }
 
+        import requests  # type: ignore
         response = requests.post(url, headers=headers, json=payload)
         if response.status_code != 200:
             raise Exception(f"ElevenLabs API error: {response.text}")
 
-        with open(output_path, "wb") as f:
-            f.write(response.content)
-        print(f"✅ ElevenLabs voiceover saved to {output_path}")
-        return output_path
+        audio = from_int16(response.content, ELEVENLABS_SAMPLE_RATE)
+        print(f"✅ ElevenLabs voiceover generated ({audio.duration:.1f}s)")
+        return audio
 
     elif TTS_PROVIDER == "coqui":
-        tts = CoquiTTS(model_name="tts_models/en/vctk/vits")
-        speaker = "p226"  # British male voice from VCTK
-        tts.tts_to_file(text=text, file_path=output_path, speaker=speaker)
-        print(f"✅ Coqui TTS voiceover (p226) saved to {output_path}")
-        return output_path
+        import numpy
+        tts = registry.get("coqui")
+        samples = numpy.asarray(tts.tts(text=text, speaker=COQUI_SPEAKER), dtype=numpy.float32)
+        audio = PcmAudio(samples, tts.synthesizer.output_sample_rate)
+        print(f"✅ Coqui TTS voiceover ({COQUI_SPEAKER}) generated ({audio.duration:.1f}s)")
+        return audio
 
     elif TTS_PROVIDER == "gtts":
+        import io
+        from gtts import gTTS  # type: ignore
         tts = gTTS(text=text, lang="en", tld="co.uk")
-        tts.save(output_path)
-        print(f"✅ gTTS voiceover saved to {output_path}")
-        return output_path
+        # gTTS only serves mp3, decoded once here and kept as PCM from then on
+        buffer = io.BytesIO()
+        tts.write_to_fp(buffer)
+        audio = decode_audio(buffer.getvalue())
+        print(f"✅ gTTS voiceover generated ({audio.duration:.1f}s)")
+        return audio
 
     else:
         raise ValueError(f"Unsupported TTS provider: {TTS_PROVIDER}")
 
 
-def generate_srt_from_audio(audio_path: str, srt_path: str) -> str:
-    """Transcribes audio and saves it as an SRT subtitle file using Whisper."""
-    model = whisper.load_model("base")
-    result = model.transcribe(audio_path)
-    segments = result['segments']
-
-    def format_timestamp(seconds: float) -> str:
-        h = int(seconds // 3600)
-        m = int((seconds % 3600) // 60)
-        s = int(seconds % 60)
-        ms = int((seconds - int(seconds)) * 1000)
-        return f"{h:02}:{m:02}:{s:02},{ms:03}"
-
-    with open(srt_path, "w", encoding="utf-8") as srt_file:
-        for i, segment in enumerate(segments, start=1):
-            start = segment['start']
-            end = segment['end']
-            text = segment['text'].strip()
-            srt_file.write(f"{i}\n")
-            srt_file.write(f"{format_timestamp(start)} --> {format_timestamp(end)}\n")
-            srt_file.write(f"{text}\n\n")
-
-    print(f"✅ Subtitles saved to {srt_path}")
-    return srt_path
+@traced()
+def transcribe_captions(audio: PcmAudio) -> list:
+    """Transcribes the narration straight from its samples with Whisper, returning (start, end, text) tuples."""
+    import numpy
+    model = registry.get("whisper")
+    samples = numpy.ascontiguousarray(resample(audio, WHISPER_SAMPLE_RATE).samples, dtype=numpy.float32)
+    result = model.transcribe(samples)
+    return [(round(s['start'], 3), round(s['end'], 3), s['text'].strip()) for s in result['segments']]
 
 
 def parse_srt_to_tuples(srt_path: str, delay_seconds: float = 0.0):
@@ -108,46 +128,68 @@ def parse_srt_to_tuples(srt_path: str, delay_seconds: float = 0.0):
     ]
 
 
+def voiceover_cache_key(text: str, gain_db: float = 6.0) -> str:
+    """Keys a narration by everything that changes its audio or captions."""
+    voice = {
+        "elevenlabs": ELEVENLABS_VOICE_ID,
+        "coqui": f"{COQUI_MODEL}/{COQUI_SPEAKER}",
+        "gtts": "en/co.uk",
+    }.get(TTS_PROVIDER)
+    return cache_key(text, TTS_PROVIDER, voice, gain_db, WHISPER_MODEL)
+
+
 def generate_voiceover_with_captions(
     text: str,
-    audio_path: str = "voice.mp3",
-    srt_path: str = "captions.srt",
-    delay: float = 8.0
+    delay: float = 8.0,
+    gain_db: float = 6.0,
+    cache=None
 ):
-    """Generates voiceover audio and corresponding subtitles with delay."""
-    audio_file = generate_voiceover(text, audio_path)
-    boost_audio_volume(audio_file, audio_file)
-    subtitle_file = generate_srt_from_audio(audio_file, srt_path)
-    caption_tuples = parse_srt_to_tuples(subtitle_file, delay_seconds=delay)
-    return audio_file, caption_tuples
-
-
-def merge_voiceover_with_video_audio(video_path: str, voice_path: str, output_path: str,delay:float = 8.0):
-    """Merges voiceover with video audio, applying volume reduction and delay."""
+    """Generates voiceover audio and corresponding captions with delay, reusing cached narrations when given a cache.
+    The audio stays in memory as PcmAudio from synthesis to the final mux."""
+    import numpy
+    if cache:
+        key = voiceover_cache_key(text, gain_db)
+        cached_audio = cache.get(key)
+        if cached_audio:
+            with open(cache.path(key, ".json"), encoding="utf-8") as f:
+                entry = json.load(f)
+            audio = PcmAudio(numpy.fromfile(cached_audio, dtype="<f4"), entry["sample_rate"])
+            print(f"♻️ Reused cached voiceover and captions ({cache.stats()})")
+            return audio, [(round(start + delay, 3), round(end + delay, 3), line) for start, end, line in entry["captions"]]
+
+    audio = apply_gain(generate_voiceover(text), gain_db)
+    captions = transcribe_captions(audio)
+
+    if cache:
+        # captions are stored without the delay so the same narration can be placed anywhere
+        captions_path = cache.path(key, ".json")
+        temp_captions = temp_path(captions_path)
+        with open(temp_captions, "w", encoding="utf-8") as f:
+            json.dump({"sample_rate": audio.sample_rate, "captions": captions}, f)
+        os.replace(temp_captions, captions_path)
+        cache.put(key, audio.samples.astype("<f4", copy=False).tofile)
+        print(f"💾 Cached voiceover and captions ({cache.stats()})")
+
+    return audio, [(round(start + delay, 3), round(end + delay, 3), line) for start, end, line in captions]
+
+
+def merge_voiceover_with_video_audio(video_path: str, voice, output_path: str,delay:float = 8.0):
+    """Merges voiceover (a file or PcmAudio) with video audio, applying volume reduction and delay."""
     if not os.path.exists(video_path):
         raise FileNotFoundError(f"Video file not found: {video_path}")
-    if not os.path.exists(voice_path):
-        raise FileNotFoundError(f"Voice file not found: {voice_path}")
-
-    video = VideoFileClip(video_path)
-    clip_audio = video.audio.volumex(0.3)
-
-    try:
-        voiceover = AudioFileClip(voice_path)
-        delayed_voiceover = voiceover.set_start(delay)
-    except Exception as e:
-        raise RuntimeError(f"Failed to process voiceover audio: {e}")
-
-    combined_audio = CompositeAudioClip([clip_audio, delayed_voiceover])
-    final_video = video.set_audio(combined_audio)
+    if not isinstance(voice, PcmAudio) and not os.path.exists(voice):
+        raise FileNotFoundError(f"Voice file not found: {voice}")
+
+    # only the audio is mixed, the video stream is copied untouched
+    clip_audio = '0:a' if probe(video_path).has_audio else None
+    filter_complex = voiceover_mix_filter(clip_audio, '1:a', 'aout', delay=delay)
+    voice_args, voice_data = voiceover_input(voice)
+    cmd = (
+        f'ffmpeg -y -i {video_path} {voice_args} -filter_complex "{filter_complex}" '
+        f'-map 0:v -map "[aout]" -c:v copy -c:a aac -b:a 192k {output_path}'
+    )
 
     print(f"🎬 Writing final video to {output_path}...")
-    final_video.write_videofile(output_path, codec="libx264", audio_codec="aac")
-
-
-def boost_audio_volume(input_path: str, output_path: str, gain_db: float = 6.0):
-    """Increases the volume of an audio file by the specified decibel gain."""
-    audio = AudioSegment.from_file(input_path)
-    louder_audio = audio + gain_db
-    louder_audio.export(output_path, format="mp3")
-    print(f"🔊 Boosted audio saved to {output_path}")
+    result = tracer.run(cmd, 'merge_voiceover', input=voice_data)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to merge voiceover into {output_path}")